@@ -14,7 +14,7 @@ import numpy as np
 import zmq
 from zmq.utils import jsonapi
 
-__all__ = ['__version__', 'BertClient', 'ConcurrentBertClient']
+__all__ = ['__version__', 'BertClient', 'ConcurrentBertClient', 'ServerBusyError', 'RaggedArray']
 
 # in the future client version must match with server version
 __version__ = '1.9.1'
@@ -28,12 +28,70 @@ _Response = namedtuple('_Response', ['id', 'content'])
 Response = namedtuple('Response', ['id', 'embedding', 'tokens'])
 
 
+class ServerBusyError(Exception):
+    """The server has too much work in flight and rejects the request, it is safe to retry later"""
+
+
+class RaggedArray(object):
+    """ Token-level embeddings of sentences with different lengths, without padding
+
+    Returned by a server started with `-ragged_output`. `data` is a [num_tokens, dim] ndarray of all tokens
+    of all sentences, the tokens of the i-th sentence are `data[offsets[i]:offsets[i + 1]]`.
+
+    .. highlight:: python
+    .. code-block:: python
+
+        vecs = bc.encode(['First do it', 'then do it right'])
+        for v in vecs:
+            # v is a [num_tokens, dim] view of the tokens of one sentence
+            print(v.shape)
+
+    """
+
+    def __init__(self, data, seq_len):
+        self.data = data
+        self.seq_len = np.asarray(seq_len, dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.seq_len)])
+
+    def __len__(self):
+        return len(self.seq_len)
+
+    def __getitem__(self, idx):
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def tolist(self):
+        return [v.tolist() for v in self]
+
+    def to_padded(self, max_len=None):
+        """ Pad all sentences to the same length
+
+        :param max_len: the length after padding, default is the length of the longest sentence
+        :return: a [num_sentences, max_len, dim] ndarray
+        :rtype: numpy.ndarray
+
+        """
+        max_len = max_len or int(self.seq_len.max())
+        x = np.zeros([len(self), max_len] + list(self.data.shape[1:]), dtype=self.data.dtype)
+        for idx, v in enumerate(self):
+            v = v[:max_len]
+            x[idx, :len(v)] = v
+        return x
+
+    @staticmethod
+    def concatenate(arrays):
+        return RaggedArray(np.concatenate([v.data for v in arrays]), np.concatenate([v.seq_len for v in arrays]))
+
+
 class BertClient(object):
     def __init__(self, ip='localhost', port=5555, port_out=5556,
                  output_fmt='ndarray', show_server_config=False,
                  identity=None, check_version=True, check_length=True,
                  check_token_info=True, ignore_all_checks=False,
-                 timeout=-1):
+                 timeout=-1, router_result=False):
         """ A client object connected to a BertServer
 
         Create a BertClient that connects to a BertServer.
@@ -50,6 +108,7 @@ class BertClient(object):
 
             # bc is automatically closed out of the context
 
+        :type router_result: bool
         :type timeout: int
         :type check_version: bool
         :type check_length: bool
@@ -71,7 +130,9 @@ class BertClient(object):
         :param check_length: check if server `max_seq_len` is less than the sentence length before sent
         :param check_token_info: check if server can return tokenization
         :param ignore_all_checks: ignore all checks, set it to True if you are not sure whether the server is ready when constructing BertClient()
-        :param timeout: set the timeout (milliseconds) for receive operation on the client, -1 means no timeout and wait until result returns
+        :param timeout: set the timeout (milliseconds) for receive operation on the client, -1 means no timeout and wait until result returns.
+            It is also sent to the server as the deadline of every request, expired requests are dropped by the server
+        :param router_result: receive results through a DEALER socket, must be consistent with "-router_result" on the server side
         """
 
         self.context = zmq.Context()
@@ -80,10 +141,18 @@ class BertClient(object):
         self.identity = identity or str(uuid.uuid4()).encode('ascii')
         self.sender.connect('tcp://%s:%d' % (ip, port))
 
-        self.receiver = self.context.socket(zmq.SUB)
-        self.receiver.setsockopt(zmq.LINGER, 0)
-        self.receiver.setsockopt(zmq.SUBSCRIBE, self.identity)
-        self.receiver.connect('tcp://%s:%d' % (ip, port_out))
+        if router_result:
+            # the server routes results to this client by its identity, and holds them until it says hello
+            self.receiver = self.context.socket(zmq.DEALER)
+            self.receiver.setsockopt(zmq.LINGER, 0)
+            self.receiver.setsockopt(zmq.IDENTITY, self.identity)
+            self.receiver.connect('tcp://%s:%d' % (ip, port_out))
+            self.receiver.send(b'HELLO')
+        else:
+            self.receiver = self.context.socket(zmq.SUB)
+            self.receiver.setsockopt(zmq.LINGER, 0)
+            self.receiver.setsockopt(zmq.SUBSCRIBE, self.identity)
+            self.receiver.connect('tcp://%s:%d' % (ip, port_out))
 
         self.request_id = 0
         self.timeout = timeout
@@ -100,9 +169,14 @@ class BertClient(object):
         self.output_fmt = output_fmt
         self.port = port
         self.port_out = port_out
+        self.router_result = router_result
         self.ip = ip
         self.length_limit = 0
         self.token_info_available = False
+        self.max_batch_size = None
+        self.req_info_available = False
+        self._vocab = None
+        self._tokenizer = None
 
         if not ignore_all_checks and (check_version or show_server_config or check_length or check_token_info):
             s_status = self.server_status
@@ -114,7 +188,10 @@ class BertClient(object):
                                          s_status['server_version'], self.status['client_version']))
 
             if check_length:
-                if s_status['max_seq_len'] is not None:
+                if s_status.get('sliding_window'):
+                    # long sequences are encoded window by window on the server, nothing is trimmed
+                    self.length_limit = 0
+                elif s_status['max_seq_len'] is not None:
                     self.length_limit = int(s_status['max_seq_len'])
                 else:
                     self.length_limit = None
@@ -122,6 +199,13 @@ class BertClient(object):
             if check_token_info:
                 self.token_info_available = bool(s_status['show_tokens_to_client'])
 
+            if s_status.get('request_info'):
+                # the server understands the request info, e.g. the deadline and the streaming flag, an older one
+                # drops any request with more than 4 frames as malformed
+                self.req_info_available = True
+                # large requests are pre-chunked by the client, so that the server can forward them without decoding
+                self.max_batch_size = int(s_status['max_batch_size'])
+
             if show_server_config:
                 self._print_dict(s_status, 'server config:')
 
@@ -135,18 +219,52 @@ class BertClient(object):
         self.receiver.close()
         self.context.term()
 
-    def _send(self, msg, msg_len=0):
+    def _send(self, msg, msg_len=0, req_info=None, extra_frames=()):
         self.request_id += 1
-        self.sender.send_multipart([self.identity, msg, b'%d' % self.request_id, b'%d' % msg_len])
+        frames = [self.identity, msg, b'%d' % self.request_id, b'%d' % msg_len]
+        if req_info is not None:
+            frames += [jsonapi.dumps(req_info)] + list(extra_frames)
+        self.sender.send_multipart(frames)
         self.pending_request.add(self.request_id)
         return self.request_id
 
+    def _send_texts(self, texts, stream=False):
+        req_info = {}
+        if self.req_info_available and self.timeout > 0:
+            # the server drops the request if it is not done within the timeout
+            req_info['timeout'] = self.timeout
+        if self.req_info_available and stream:
+            # the server sends back each part of the result as soon as it is computed
+            req_info['stream'] = True
+        if self.max_batch_size and len(texts) > self.max_batch_size:
+            # split a large request into chunks of the server's batch size, each one is sent as a separate frame
+            chunks = [texts[i:(i + self.max_batch_size)] for i in range(0, len(texts), self.max_batch_size)]
+            frames = [jsonapi.dumps(c) for c in chunks]
+            req_info['chunk_size'] = [len(c) for c in chunks]
+            return self._send(frames[0], len(texts), req_info, frames[1:])
+        return self._send(jsonapi.dumps(texts), len(texts), req_info or None)
+
+    def _send_ids(self, input_ids, segment_ids=None):
+        req_info = {'id_len': [len(v) for v in input_ids], 'segment_ids': segment_ids is not None}
+        if self.timeout > 0:
+            req_info['timeout'] = self.timeout
+        # the ids and the optional segment ids of all sentences are sent as one int32 frame
+        ids = list(input_ids) + (list(segment_ids) if segment_ids is not None else [])
+        msg = np.concatenate([np.asarray(v, dtype=np.int32).ravel() for v in ids])
+        return self._send(msg.tobytes(), len(input_ids), req_info)
+
     def _recv(self, wait_for_req_id=None):
         try:
             while True:
+                if wait_for_req_id is None and self.pending_response:
+                    # any response is fine, take the one received while waiting for another request
+                    wait_for_req_id = next(iter(self.pending_response))
                 # a request has been returned and found in pending_response
                 if wait_for_req_id in self.pending_response:
-                    response = self.pending_response.pop(wait_for_req_id)
+                    # a streamed request may have several responses waiting
+                    response = self.pending_response[wait_for_req_id].pop(0)
+                    if not self.pending_response[wait_for_req_id]:
+                        self.pending_response.pop(wait_for_req_id)
                     return _Response(wait_for_req_id, response)
 
                 # receive a response
@@ -155,10 +273,10 @@ class BertClient(object):
 
                 # if not wait for particular response then simply return
                 if not wait_for_req_id or (wait_for_req_id == request_id):
-                    self.pending_request.remove(request_id)
+                    self.pending_request.discard(request_id)
                     return _Response(request_id, response)
                 elif wait_for_req_id != request_id:
-                    self.pending_response[request_id] = response
+                    self.pending_response.setdefault(request_id, []).append(response)
                     # wait for the next response
         except Exception as e:
             raise e
@@ -168,9 +286,35 @@ class BertClient(object):
 
     def _recv_ndarray(self, wait_for_req_id=None):
         request_id, response = self._recv(wait_for_req_id)
+        X, arr_info = self._decode_ndarray(request_id, response)
+        return Response(request_id, self.formatter(X), self._decode_tokens(arr_info, response))
+
+    @staticmethod
+    def _decode_ndarray(request_id, response):
+        if response[1] == b'SERVER_BUSY':
+            busy_info = jsonapi.loads(response[2])
+            if busy_info.get('sink_over_budget'):
+                raise ServerBusyError('request %d is rejected as the server is over its memory budget of results, '
+                                      'please retry later or use another server' % request_id)
+            raise ServerBusyError('request %d is rejected as the server is busy with %d sequences (%d bytes) in flight, '
+                                  'please retry later or use another server' % (
+                                      request_id, busy_info['num_inflight_seq'], busy_info['inflight_size_bytes']))
         arr_info, arr_val = jsonapi.loads(response[1]), response[2]
-        X = np.frombuffer(_buffer(arr_val), dtype=str(arr_info['dtype']))
-        return Response(request_id, self.formatter(X.reshape(arr_info['shape'])), arr_info.get('tokens', ''))
+        X = np.frombuffer(_buffer(arr_val), dtype=str(arr_info['dtype'])).reshape(arr_info['shape'])
+        if 'seq_len' in arr_info:
+            # ragged token-level embeddings from a server with "-ragged_output"
+            X = RaggedArray(X, arr_info['seq_len'])
+        return X, arr_info
+
+    def _decode_tokens(self, arr_info, response):
+        if 'token_ids' not in arr_info:
+            return arr_info.get('tokens', '')
+        # token ids from a server with "-compact_tokens", they are in the frame after the embeddings
+        ids = np.frombuffer(_buffer(response[3]), dtype=str(arr_info['token_ids']['dtype']))
+        vocab = self.vocab
+        tokens = [vocab[i] for i in ids.tolist()]
+        offsets = np.cumsum([0] + arr_info['token_ids']['seq_len']).tolist()
+        return [tokens[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
 
     @property
     def status(self):
@@ -191,9 +335,29 @@ class BertClient(object):
             'port_out': self.port_out,
             'server_ip': self.ip,
             'client_version': __version__,
-            'timeout': self.timeout
+            'timeout': self.timeout,
+            'router_result': self.router_result
         }
 
+    def cancel(self, req_ids=None):
+        """ Cancel pending requests, the server stops working on them and never sends their results back
+
+        On a server without the request info (see "request_info" of the server status), the requests are only
+        forgotten by the client, the server still encodes them and sends their results back.
+
+        :type req_ids: list[int]
+        :param req_ids: ids of the requests to cancel, default is all pending requests
+
+        """
+        if req_ids is None:
+            req_ids = list(self.pending_request)
+        for req_id in req_ids:
+            if self.req_info_available:
+                # an older server does not know the command and would take it as a request with the message "CANCEL"
+                self.sender.send_multipart([self.identity, b'CANCEL', b'%d' % req_id, b'0'])
+            self.pending_request.discard(req_id)
+            self.pending_response.pop(req_id, None)
+
     def _timeout(func):
         @wraps(func)
         def arg_wrapper(self, *args, **kwargs):
@@ -202,22 +366,28 @@ class BertClient(object):
                 self.receiver.setsockopt(zmq.RCVTIMEO, -1)
             else:
                 self.receiver.setsockopt(zmq.RCVTIMEO, self.timeout)
+            last_req_id = self.request_id
             try:
                 return func(self, *args, **kwargs)
             except zmq.error.Again as _e:
-                t_e = TimeoutError(
-                    'no response from the server (with "timeout"=%d ms), please check the following:'
-                    'is the server still online? is the network broken? are "port" and "port_out" correct? '
-                    'are you encoding a huge amount of data whereas the timeout is too small for that?' % self.timeout)
-                if _py2:
-                    raise t_e
-                else:
-                    _raise(t_e, _e)
+                # the requests sent in this call are abandoned, tell the server to stop working on them
+                self.cancel(range(last_req_id + 1, self.request_id + 1))
+                self._raise_timeout_error(_e)
             finally:
                 self.receiver.setsockopt(zmq.RCVTIMEO, -1)
 
         return arg_wrapper
 
+    def _raise_timeout_error(self, _e):
+        t_e = TimeoutError(
+            'no response from the server (with "timeout"=%d ms), please check the following:'
+            'is the server still online? is the network broken? are "port" and "port_out" correct? '
+            'are you encoding a huge amount of data whereas the timeout is too small for that?' % self.timeout)
+        if _py2:
+            raise t_e
+        else:
+            _raise(t_e, _e)
+
     @property
     @_timeout
     def server_status(self):
@@ -231,6 +401,36 @@ class BertClient(object):
         req_id = self._send(b'SHOW_CONFIG')
         return jsonapi.loads(self._recv(req_id).content[1])
 
+    @property
+    @_timeout
+    def vocab(self):
+        """
+            Get the vocabulary of the server, it is fetched once and cached by the client
+
+        :return: the tokens of the vocabulary, where the index of a token is its id
+        :rtype: list[str]
+
+        """
+        if self._vocab is None:
+            req_id = self._send(b'SHOW_VOCAB')
+            self._vocab = jsonapi.loads(self._recv(req_id).content[1])
+        return self._vocab
+
+    @property
+    def tokenizer(self):
+        """
+            Get a tokenizer with the vocabulary and the lower-casing of the server, for `encode_ids`
+
+        :return: the tokenizer, it is built once and cached by the client
+        :rtype: bert_serving.client.tokenization.FullTokenizer
+
+        """
+        if self._tokenizer is None:
+            from .tokenization import FullTokenizer
+            # a "-cased_tokenization" server must get the ids of the cased tokens
+            self._tokenizer = FullTokenizer(self.vocab, do_lower_case=self.server_status['do_lower_case'])
+        return self._tokenizer
+
     @_timeout
     def encode(self, texts, blocking=True, is_tokenized=False, show_tokens=False):
         """ Encode a list of strings to a list of vectors
@@ -265,9 +465,124 @@ class BertClient(object):
         :param blocking: wait until the encoded result is returned from the server. If false, will immediately return.
         :param timeout: throw a timeout error when the encoding takes longer than the predefined timeout.
         :return: encoded sentence/token-level embeddings, rows correspond to sentences
-        :rtype: numpy.ndarray or list[list[float]]
+        :rtype: numpy.ndarray or list[list[float]] or RaggedArray
+
+        """
+        self._check_texts(texts, is_tokenized, show_tokens)
+        req_id = self._send_texts(texts)
+        if not blocking:
+            return None
+        r = self._recv_ndarray(req_id)
+        if self.token_info_available and show_tokens:
+            return r.embedding, r.tokens
+        return r.embedding
+
+    @_timeout
+    def encode_ids(self, input_ids, segment_ids=None, blocking=True, show_tokens=False):
+        """ Encode sentences that are already converted to WordPiece ids, the server does no tokenization at all
+
+        Each sentence is a list of token ids including `[CLS]` and `[SEP]`, e.g. from `BertClient.tokenizer`,
+        which has the vocabulary and the lower-casing of the server. This moves the tokenization cost from the server to the client.
+        Sentences longer than `max_seq_len` of the server are trimmed on the right side, keeping the last `[SEP]`.
+
+        .. highlight:: python
+        .. code-block:: python
+
+            with BertClient() as bc:
+                input_ids, segment_ids = zip(*[bc.tokenizer.encode(t) for t in texts])
+                vecs = bc.encode_ids(input_ids, segment_ids)
+
+        :type input_ids: list[list[int]] or numpy.ndarray
+        :type segment_ids: list[list[int]] or numpy.ndarray
+        :type blocking: bool
+        :type show_tokens: bool
+        :param input_ids: token ids of the sentences
+        :param segment_ids: segment ids of the sentences, with the same lengths as `input_ids`. Default all zeros
+        :param blocking: wait until the encoded result is returned from the server. If false, will immediately return.
+        :param show_tokens: whether to include the tokens of the ids from the server.
+            If true, the return of the function will be a tuple
+        :return: encoded sentence/token-level embeddings, rows correspond to sentences
+        :rtype: numpy.ndarray or list[list[float]] or RaggedArray
 
         """
+        if not self.req_info_available:
+            raise AttributeError('"encode_ids" requires a server that takes the request info (see "request_info" '
+                                 'of the server status), and "BertClient(ignore_all_checks=False)"')
+        if not len(input_ids):
+            raise ValueError('"input_ids" must be a non-empty list')
+        for idx, v in enumerate(input_ids):
+            if not len(v):
+                raise ValueError('all sentences in "input_ids" must be non-empty, but sentence %d has no ids' % idx)
+        if segment_ids is not None and [len(v) for v in segment_ids] != [len(v) for v in input_ids]:
+            raise ValueError('"segment_ids" must have the same lengths as "input_ids"')
+        if self.length_limit and any(len(v) > self.length_limit for v in input_ids):
+            warnings.warn('some of your sentences have more tokens than "max_seq_len=%d" set on the server, '
+                          'they are trimmed on the server side' % self.length_limit)
+        if not self.token_info_available and show_tokens:
+            warnings.warn('"show_tokens=True", but the server does not support showing tokenization info to clients.')
+        req_id = self._send_ids(input_ids, segment_ids)
+        if not blocking:
+            return None
+        r = self._recv_ndarray(req_id)
+        if self.token_info_available and show_tokens:
+            return r.embedding, r.tokens
+        return r.embedding
+
+    def encode_stream(self, texts, is_tokenized=False, show_tokens=False):
+        """ Encode a list of strings and yield the vectors part by part, as soon as each part is computed
+
+        The server sends back every batch of a large request once it is done, instead of the whole result at the end.
+        Parts arrive in no particular order, each one comes with the positions of its sentences in `texts`.
+        If the consumer stops early, the rest of the request is cancelled on the server.
+
+        .. highlight:: python
+        .. code-block:: python
+
+            with BertClient() as bc:
+                vecs = np.zeros([len(texts), 768], dtype=np.float32)
+                for idx, v in bc.encode_stream(texts):
+                    vecs[idx] = v
+
+        :type is_tokenized: bool
+        :type show_tokens: bool
+        :type texts: list[str] or list[list[str]]
+        :param is_tokenized: whether the input texts is already tokenized
+        :param show_tokens: whether to include tokenization result from the server. If true, each part will be a triple
+        :param texts: list of sentence to be encoded
+        :return: a generator that yields the positions of the sentences and their encoded vectors in a tuple
+        :rtype: Iterator[tuple(numpy.ndarray, numpy.ndarray)]
+
+        """
+        self._check_texts(texts, is_tokenized, show_tokens)
+        req_id = self._send_texts(texts, stream=True)
+        num_done = 0
+        try:
+            while num_done < len(texts):
+                # the timeout applies to each part, set it every time as other calls may reset it in between
+                self.receiver.setsockopt(zmq.RCVTIMEO, self.timeout)
+                request_id, response = self._recv(req_id)
+                self.receiver.setsockopt(zmq.RCVTIMEO, -1)
+                X, arr_info = self._decode_ndarray(request_id, response)
+                if 'index' in arr_info:
+                    # the server has reordered the sentences, e.g. by "length_bucketing"
+                    idx = np.array(arr_info['index'])
+                else:
+                    # a server without streaming sends the whole result at offset 0
+                    idx = np.arange(arr_info.get('offset', 0), arr_info.get('offset', 0) + len(X))
+                num_done += len(X)
+                if self.token_info_available and show_tokens:
+                    yield self.formatter(idx), self.formatter(X), self._decode_tokens(arr_info, response)
+                else:
+                    yield self.formatter(idx), self.formatter(X)
+        except zmq.error.Again as _e:
+            self._raise_timeout_error(_e)
+        finally:
+            self.receiver.setsockopt(zmq.RCVTIMEO, -1)
+            if num_done < len(texts):
+                # the consumer stops early or the request times out, the rest of the result is not needed
+                self.cancel([req_id])
+
+    def _check_texts(self, texts, is_tokenized, show_tokens):
         if is_tokenized:
             self._check_input_lst_lst_str(texts)
         else:
@@ -285,18 +600,11 @@ class BertClient(object):
                           'when you do not want to display this warning\n'
                           '- or, start a new server with a larger "max_seq_len"' % self.length_limit)
 
-        req_id = self._send(jsonapi.dumps(texts), len(texts))
-        if not blocking:
-            return None
-        r = self._recv_ndarray(req_id)
-        if self.token_info_available and show_tokens:
-            return r.embedding, r.tokens
-        elif not self.token_info_available and show_tokens:
+        if not self.token_info_available and show_tokens:
             warnings.warn('"show_tokens=True", but the server does not support showing tokenization info to clients.\n'
                           'here is what you can do:\n'
                           '- start a new server with "bert-serving-start -show_tokens_to_client ..."\n'
                           '- or, use "encode(show_tokens=False)"')
-        return r.embedding
 
     def fetch(self, delay=.0):
         """ Fetch the encoded vectors from server, use it with `encode(blocking=False)`
@@ -336,7 +644,9 @@ class BertClient(object):
                 tmp = sorted(tmp, key=lambda v: v.id)
             tmp = [v.embedding for v in tmp]
             if concat:
-                if self.output_fmt == 'ndarray':
+                if self.output_fmt == 'ndarray' and isinstance(tmp[0], RaggedArray):
+                    tmp = RaggedArray.concatenate(tmp)
+                elif self.output_fmt == 'ndarray':
                     tmp = np.concatenate(tmp, axis=0)
                 elif self.output_fmt == 'list':
                     tmp = [vv for v in tmp for vv in v]
@@ -461,7 +771,8 @@ class ConcurrentBertClient(BertClient):
             try:
                 with BCManager(self.available_bc) as bc:
                     f = getattr(bc, func.__name__)
-                    r = f if isinstance(f, dict) else f(*args, **kwargs)
+                    # a property is already evaluated by getattr, e.g. the status dict or the tokenizer
+                    r = f(*args, **kwargs) if callable(f) else f
                 return r
             except IndexError:
                 raise RuntimeError('Too many concurrent connections!'
@@ -474,6 +785,10 @@ class ConcurrentBertClient(BertClient):
     def encode(self, **kwargs):
         pass
 
+    @_concurrent
+    def encode_ids(self, **kwargs):
+        pass
+
     @property
     @_concurrent
     def server_status(self):
@@ -484,6 +799,22 @@ class ConcurrentBertClient(BertClient):
     def status(self):
         pass
 
+    @property
+    @_concurrent
+    def vocab(self):
+        pass
+
+    @property
+    @_concurrent
+    def tokenizer(self):
+        pass
+
+    def encode_stream(self, **kwargs):
+        raise NotImplementedError('Streaming of "ConcurrentBertClient" is not implemented yet')
+
+    def cancel(self, **kwargs):
+        raise NotImplementedError('Cancelling requests of "ConcurrentBertClient" is not implemented yet')
+
     def fetch(self, **kwargs):
         raise NotImplementedError('Async encoding of "ConcurrentBertClient" is not implemented yet')
 
@@ -1,13 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # Han Xiao <artex.xh@gmail.com> <https://hanxiao.github.io>
+import heapq
 import multiprocessing
 import os
 import random
 import sys
 import threading
 import time
-from collections import defaultdict
+import zlib
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime
 from itertools import chain
 from multiprocessing import Process
@@ -19,14 +21,21 @@ import zmq.decorators as zmqd
 from termcolor import colored
 from zmq.utils import jsonapi
 
+from .cache import EmbeddingCache
+from .engine import SessionEngine
 from .helper import *
 from .http import BertHTTPProxy
+from .shm import clear_shm_arrays, get_shm_path, open_shm_array, remove_shm_array
 from .zmq_decor import multi_socket
 
 __all__ = ['__version__', 'BertServer']
 __version__ = '1.9.1'
 
 _tf_ver_ = check_tf_version()
+_max_num_dropped_job = 10000  # number of dropped job ids remembered, so that their late results are ignored
+_max_undelivered_time = 60  # seconds that results are held for a client that has not connected to the sink
+_sink_resume_ratio = 0.8  # a sink over its memory budget resumes taking new jobs below this fraction of the budget
+_sink_report_interval = 1  # seconds between two memory reports of a sink to the ventilator
 
 
 class ServerCmd:
@@ -34,7 +43,15 @@ class ServerCmd:
     show_config = b'SHOW_CONFIG'
     new_job = b'REGISTER'
     data_token = b'TOKENS'
+    data_token_ids = b'TOKEN_IDS'
+    show_vocab = b'SHOW_VOCAB'
     data_embed = b'EMBEDDINGS'
+    data_embed_shm = b'SHM_EMBEDDINGS'
+    cancel = b'CANCEL'
+    job_done = b'DONE'
+    job_dispatched = b'DISPATCHED'
+    busy = b'SERVER_BUSY'
+    sink_memory = b'SINK_MEMORY'
 
     @staticmethod
     def is_valid(cmd):
@@ -50,7 +67,37 @@ class BertServer(threading.Thread):
         self.max_seq_len = args.max_seq_len
         self.num_worker = args.num_worker
         self.max_batch_size = args.max_batch_size
+        self.max_tokens_per_batch = args.max_tokens_per_batch
         self.num_concurrent_socket = max(8, args.num_worker * 2)  # optimize concurrency for multi-clients
+        self.num_tokenizer = args.num_tokenizer
+        # turn off the options that do not work together, the same way as "bert-serving-export"
+        normalize_args(args, self.logger)
+        # in least-loaded dispatch, each worker additionally listens on its own socket
+        self.num_dispatch_socket = args.num_worker if args.least_loaded_dispatch else 0
+        self.num_sink = args.num_sink
+        self.max_inflight_seq = args.max_inflight_seq
+        self.max_inflight_bytes = int(args.max_inflight_size * 1024 * 1024)
+        self.fair_queue = None
+        if args.fair_queuing:
+            self.fair_queue = FairQueue(args.client_weight, args.client_rate_limit, args.max_batch_size)
+        elif args.client_weight or args.client_rate_limit:
+            self.logger.warning('"client_weight" and "client_rate_limit" only work with "fair_queuing", they are ignored')
+        self.length_bucketing = args.length_bucketing and args.max_seq_len is None
+        if args.length_bucketing and not self.length_bucketing:
+            self.logger.warning('"length_bucketing" only works with "max_seq_len=NONE", it is ignored')
+        self._vocab = None
+        self.cache = None
+        if args.cache_size > 0:
+            from .graph import PoolingStrategy
+            if args.show_tokens_to_client:
+                self.logger.warning('"cache_size" does not work with "show_tokens_to_client", cache is disabled')
+            elif args.ragged_output:
+                self.logger.warning('"cache_size" does not work with "ragged_output", cache is disabled')
+            elif args.max_seq_len is None and args.pooling_strategy == PoolingStrategy.NONE:
+                self.logger.warning('"cache_size" does not work with "max_seq_len=NONE" and "pooling_strategy=NONE", '
+                                    'cache is disabled')
+            else:
+                self.cache = EmbeddingCache(int(args.cache_size * 1024 * 1024), args.cache_policy, args)
         self.port = args.port
         self.args = args
         self.status_args = {k: (v if k != 'pooling_strategy' else v.value) for k, v in sorted(vars(args).items())}
@@ -61,6 +108,8 @@ class BertServer(threading.Thread):
             'pyzmq_version': zmq.pyzmq_version(),
             'zmq_version': zmq.zmq_version(),
             'server_start_time': str(datetime.now()),
+            # the server takes the request info frame after the 4 frames of a request, and pre-chunked requests
+            'request_info': True,
         }
         self.processes = []
         self.logger.info('freeze, optimize and export graph, could take a while...')
@@ -74,6 +123,7 @@ class BertServer(threading.Thread):
             self.logger.info('optimized graph is stored at: %s' % self.graph_path)
         else:
             raise FileNotFoundError('graph optimization fails and returns empty result')
+        self.padding_buckets = get_padding_buckets(self.args, self.bert_config)
         self.is_ready = threading.Event()
 
     def __enter__(self):
@@ -115,33 +165,121 @@ class BertServer(threading.Thread):
 
     @zmqd.context()
     @zmqd.socket(zmq.PULL)
-    @zmqd.socket(zmq.PAIR)
+    @zmqd.socket(zmq.PULL)
+    @zmqd.socket(zmq.PUB)
     @multi_socket(zmq.PUSH, num_socket='num_concurrent_socket')
-    def _run(self, _, frontend, sink, *backend_socks):
+    @multi_socket(zmq.PUSH, num_socket='num_dispatch_socket')
+    @multi_socket(zmq.PAIR, num_socket='num_sink')
+    def _run(self, _, frontend, report, canceller, *backend_socks):
+
+        def push_new_job(_job_id, _json_msg, _msg_len, _job_info=None):
+            if fair_queue is not None:
+                # the job waits in the queue of its client until a worker has room for it,
+                # merged micro-batches of different clients share one queue but are charged to their clients
+                _client, _charges = _job_id.split(b'#')[0], None
+                if b'|' in _job_id:
+                    _client, _charges = b'', defaultdict(int)
+                    for _k, _, _n in MicroBatch.split(_job_id):
+                        _charges[_k.split(b'#')[0]] += _n
+                fair_queue.add(_client, _job_id, _json_msg, _msg_len, _job_info, _charges)
+                if not sink_full:
+                    release_jobs()
+            else:
+                send_job(_job_id, _json_msg, _msg_len, _job_info)
+
+        def release_jobs():
+            # keep at most two batches queued at each worker, so that a new job from another client
+            # does not wait behind all batches of a huge request
+            while num_dispatched_job < 2 * self.num_worker:
+                _job = fair_queue.pop()
+                if _job is None:
+                    break
+                if _job[3] and _job[3].get('deadline', np.inf) < time.time():
+                    self.logger.info('drop expired job\tjob id: %s' % _job[0])
+                    mark_dispatched(_job[0])
+                    continue
+                send_job(*_job)
+
+        def mark_dispatched(_job_id):
+            # a job is dispatched once all of its parts have left the micro-batch and the fair queue,
+            # its sink then starts counting "sink_job_ttl"
+            for _k, _, _ in MicroBatch.split(_job_id):
+                _k = _k.split(b'@')[0]
+                if _k not in undispatched:
+                    continue
+                undispatched[_k] -= 1
+                if not undispatched[_k]:
+                    del undispatched[_k]
+                    if self.args.sink_job_ttl:
+                        _client, _req_id = _k.split(b'#')
+                        sink_socks[BertSink.get_sink_id(_k, self.num_sink)].send_multipart(
+                            [_client, ServerCmd.job_dispatched, b'', _req_id])
+
+        def send_job(_job_id, _json_msg, _msg_len, _job_info=None):
+            nonlocal num_dispatched_job
+            mark_dispatched(_job_id)
+            num_dispatched_job += 1
+            if self.args.least_loaded_dispatch:
+                # send to the worker with the fewest pending sequences
+                _worker_id = int(np.argmin(worker_load))
+                worker_load[_worker_id] += _msg_len
+                _sock = dispatch_socks[_worker_id]
+            else:
+                # backend_socks[0] is always at the highest priority
+                _sock = backend_socks[0] if _msg_len <= self.args.priority_batch_size else rand_backend_socket
+            # optional job info for workers, e.g. they skip the job if its deadline has passed
+            _sock.send_multipart([_job_id, _json_msg] + ([jsonapi.dumps(_job_info)] if _job_info else []))
 
-        def push_new_job(_job_id, _json_msg, _msg_len):
-            # backend_socks[0] is always at the highest priority
-            _sock = backend_socks[0] if _msg_len <= self.args.priority_batch_size else rand_backend_socket
-            _sock.send_multipart([_job_id, _json_msg])
+        backend_socks, dispatch_socks, sink_socks = (
+            backend_socks[:self.num_concurrent_socket],
+            backend_socks[self.num_concurrent_socket:(self.num_concurrent_socket + self.num_dispatch_socket)],
+            backend_socks[(self.num_concurrent_socket + self.num_dispatch_socket):])
 
         # bind all sockets
         self.logger.info('bind all sockets')
         frontend.bind('tcp://*:%d' % self.port)
-        addr_front2sink = auto_bind(sink)
+        addr_front2sink = [auto_bind(b) for b in sink_socks]
+        addr_report = auto_bind(report)
+        addr_cancel = auto_bind(canceller)
         addr_backend_list = [auto_bind(b) for b in backend_socks]
-        self.logger.info('open %d ventilator-worker sockets' % len(addr_backend_list))
+        addr_dispatch_list = [auto_bind(b) for b in dispatch_socks]
+        self.logger.info('open %d ventilator-worker sockets' % (len(addr_backend_list) + len(addr_dispatch_list)))
+
+        # start the sink processes, each of them assembles the jobs of its own shard
+        self.logger.info('start %d sink(s)' % self.num_sink)
+        addr_sink, addr_sink_result = [], []
+        for idx, (addr, sink) in enumerate(zip(addr_front2sink, sink_socks)):
+            proc_sink = BertSink(self.args, addr, self.bert_config, idx)
+            self.processes.append(proc_sink)
+            proc_sink.start()
+            addr_sink.append(sink.recv().decode('ascii'))
+            addr_sink_result.append(sink.recv().decode('ascii'))
+
+        if self.num_sink > 1:
+            # a single proxy sends the results of all sinks to clients
+            self.logger.info('start the result proxy')
+            proc_proxy = BertResultProxy(self.args, addr_sink_result)
+            self.processes.append(proc_proxy)
+            proc_proxy.start()
 
-        # start the sink process
-        self.logger.info('start the sink')
-        proc_sink = BertSink(self.args, addr_front2sink, self.bert_config)
-        self.processes.append(proc_sink)
-        proc_sink.start()
-        addr_sink = sink.recv().decode('ascii')
+        # start the tokenizer processes, they turn raw text into features between the ventilator and the workers
+        addr_tokenizer = []
+        if self.num_tokenizer:
+            self.logger.info('start %d tokenizer(s)' % self.num_tokenizer)
+            for idx in range(self.num_tokenizer):
+                process = BertTokenizer(idx, self.args, addr_backend_list, addr_sink, addr_report, addr_cancel,
+                                        self.bert_config)
+                self.processes.append(process)
+                process.start()
+            # each tokenizer tells the address that workers connect to
+            addr_tokenizer = [report.recv_multipart()[1].decode('ascii') for _ in range(self.num_tokenizer)]
 
         # start the backend processes
         device_map = self._get_device_map()
         for idx, device_id in enumerate(device_map):
-            process = BertWorker(idx, self.args, addr_backend_list, addr_sink, device_id,
+            # workers receive the jobs from the tokenizers if there are, otherwise from the ventilator
+            addr_worker = addr_tokenizer or (addr_backend_list + addr_dispatch_list[idx:(idx + 1)])
+            process = BertWorker(idx, self.args, addr_worker, addr_sink, addr_report, addr_cancel, device_id,
                                  self.graph_path, self.bert_config)
             self.processes.append(process)
             process.start()
@@ -153,8 +291,36 @@ class BertServer(threading.Thread):
             self.processes.append(proc_proxy)
             proc_proxy.start()
 
+        def flush_micro_batch(is_timeout=False):
+            _job_id, _msg, _msg_len, _num_job, _deadline = micro_batch.pop()
+            self.logger.info('flush micro-batch\tsize: %d\tnum job: %d\ttimeout: %s' % (_msg_len, _num_job, is_timeout))
+            server_status.update_micro_batch(_msg_len / self.max_batch_size, _num_job, is_timeout)
+            push_new_job(_job_id, _msg, _msg_len, {'deadline': _deadline} if _deadline else None)
+
         rand_backend_socket = None
         server_status = ServerStatistic()
+        fair_queue = self.fair_queue
+        # number of jobs sent to workers but not yet finished
+        num_dispatched_job = 0
+        micro_batch = MicroBatch(self.max_batch_size, self.args.micro_batch_timeout)
+        # number of sequences dispatched to each worker but not yet finished
+        worker_load = [0] * self.num_worker
+        # cache keys of the sequences sent to workers, waiting for their embeddings from the sink
+        pending_cache = {}
+        # number of sequences and bytes of the admitted jobs that are not yet finished
+        inflight_jobs = {}
+        inflight_seq, inflight_bytes = 0, 0
+        # the last memory report of each sink, and whether any of them is over its budget
+        sink_memory = [{'num_bytes': 0, 'num_job': 0, 'num_evicted_job': 0, 'is_full': False}] * self.num_sink
+        sink_full = False
+        # number of parts of each job that are not yet sent to workers, plus one while the job is being split
+        undispatched = defaultdict(int)
+
+        poller = zmq.Poller()
+        poller.register(frontend, zmq.POLLIN)
+        poller.register(report, zmq.POLLIN)
+        for sink in sink_socks:
+            poller.register(sink, zmq.POLLIN)
 
         for p in self.processes:
             p.is_ready.wait()
@@ -163,38 +329,215 @@ class BertServer(threading.Thread):
         self.logger.info('all set, ready to serve request!')
 
         while True:
+            poll_timeouts = [v for v in (micro_batch.time_left, fair_queue.time_left if fair_queue else None)
+                             if v is not None]
+            socks = dict(poller.poll(min(poll_timeouts) if poll_timeouts else None))
+            if micro_batch.size and not micro_batch.time_left:
+                flush_micro_batch(is_timeout=True)
+            if socks.get(report) == zmq.POLLIN:
+                # a worker finishes a batch and gives back its credit
+                worker_id, num_done, *token_usage = report.recv_multipart()
+                num_dispatched_job -= 1
+                if token_usage:
+                    server_status.update_token_usage(*map(int, token_usage))
+                if self.args.least_loaded_dispatch:
+                    worker_load[int(worker_id)] -= int(num_done)
+            if fair_queue and not sink_full:
+                # release the jobs that wait for a free worker or for the rate limit of their clients
+                release_jobs()
+            for sink in [v for v in sink_socks if socks.get(v) == zmq.POLLIN]:
+                # a sink finishes or drops a job
+                client, msg_type, msg_info, req_id, *extra = sink.recv_multipart()
+                if msg_type == ServerCmd.sink_memory:
+                    # a sink reports its memory, new requests are not taken while any sink is over its budget
+                    sink_memory[sink_socks.index(sink)] = jsonapi.loads(msg_info)
+                    is_full = any(v['is_full'] for v in sink_memory)
+                    if is_full != sink_full:
+                        sink_full = is_full
+                        if sink_full:
+                            self.logger.warning('sink memory over budget, reject new requests\tsize: %d bytes'
+                                                % sum(v['num_bytes'] for v in sink_memory))
+                        else:
+                            self.logger.info('sink memory below budget, resume taking new requests')
+                    continue
+                job_id = client + b'#' + req_id
+                arr_info = jsonapi.loads(msg_info) if msg_type == ServerCmd.data_embed else {}
+                if 'partial_id' not in arr_info:
+                    job_size = inflight_jobs.pop(job_id, None)
+                    if job_size:
+                        inflight_seq -= job_size[0]
+                        inflight_bytes -= job_size[1]
+                if msg_type == ServerCmd.data_embed:
+                    # the sink sends back the newly computed embeddings of a job for caching,
+                    # a streamed job sends them part by part and is still in flight
+                    x = np.frombuffer(memoryview(extra[0]), dtype=arr_info['dtype']).reshape(arr_info['shape'])
+                    # the keys are gone if the job has been cancelled in the meantime
+                    if 'partial_id' in arr_info:
+                        keys = pending_cache.get(job_id, [])[arr_info['partial_id']:(arr_info['partial_id'] + len(x))]
+                    else:
+                        keys = pending_cache.pop(job_id, [])
+                    num_evicted = sum(self.cache.put(k, v.copy()) for k, v in zip(keys, x))
+                    server_status.update_cache(num_evicted=num_evicted)
+                elif msg_type in (ServerCmd.cancel, ServerCmd.job_done):
+                    # the sink drops an expired or cancelled job, or finishes a streamed job
+                    pending_cache.pop(job_id, None)
+            if socks.get(frontend) != zmq.POLLIN:
+                continue
             try:
                 request = frontend.recv_multipart()
-                client, msg, req_id, msg_len = request
+                client, msg, req_id, msg_len, *extra = request
                 assert req_id.isdigit()
                 assert msg_len.isdigit()
-            except (ValueError, AssertionError):
-                self.logger.error('received a wrongly-formatted request (expected 4 frames, got %d)' % len(request))
+                # optional request info, followed by the rest of the chunks if the client pre-chunks the request
+                req_info = jsonapi.loads(extra[0]) if extra else {}
+                assert isinstance(req_info, dict)
+                chunks, chunk_sizes = [msg] + extra[1:], req_info.get('chunk_size', [int(msg_len)])
+                assert self._is_int_list(chunk_sizes, 0)
+                assert len(chunks) == len(chunk_sizes) and sum(chunk_sizes) == int(msg_len)
+                timeout = req_info.get('timeout')
+                assert timeout is None or (isinstance(timeout, (int, float)) and not isinstance(timeout, bool)
+                                           and timeout > 0)
+                # token ids from "encode_ids" are one binary frame, with the number of ids of each sentence
+                if 'id_len' in req_info:
+                    id_len = req_info['id_len']
+                    assert self._is_int_list(id_len, 1) and len(id_len) == int(msg_len)
+                    # int32 ids of all sentences, followed by as many segment ids if given
+                    assert len(msg) == 4 * sum(id_len) * (2 if req_info.get('segment_ids') else 1)
+            except (ValueError, TypeError, AssertionError):
+                self.logger.error('received a wrongly-formatted request (expected at least 4 frames, got %d)'
+                                  % len(request))
                 self.logger.error('\n'.join('field %d: %s' % (idx, k) for idx, k in enumerate(request)), exc_info=True)
             else:
                 server_status.update(request)
+                # all messages of a request go to the sink of its shard
+                sink = sink_socks[BertSink.get_sink_id(client + b'#' + req_id, self.num_sink)]
                 if msg == ServerCmd.terminate:
                     break
+                elif msg == ServerCmd.cancel:
+                    self.logger.info('cancel request\treq id: %d\tclient: %s' % (int(req_id), client))
+                    job_id = client + b'#' + req_id
+                    micro_batch.remove(job_id)
+                    if fair_queue is not None:
+                        fair_queue.remove(client, job_id)
+                    pending_cache.pop(job_id, None)
+                    undispatched.pop(job_id, None)
+                    canceller.send(job_id)
+                    sink.send_multipart([client, msg, b'', req_id])
+                elif msg == ServerCmd.show_vocab:
+                    self.logger.info('new vocab request\treq id: %d\tclient: %s' % (int(req_id), client))
+                    sink.send_multipart([client, msg, self.vocab, req_id])
                 elif msg == ServerCmd.show_config:
                     self.logger.info('new config request\treq id: %d\tclient: %s' % (int(req_id), client))
                     status_runtime = {'client': client.decode('ascii'),
                                       'num_process': len(self.processes),
-                                      'ventilator -> worker': addr_backend_list,
-                                      'worker -> sink': addr_sink,
-                                      'ventilator <-> sink': addr_front2sink,
+                                      'ventilator -> worker': addr_backend_list + addr_dispatch_list,
+                                      'worker -> ventilator': addr_report,
+                                      'ventilator -> worker (cancel)': addr_cancel,
+                                      'tokenizer -> worker': addr_tokenizer,
+                                      'worker_load': worker_load,
+                                      'num_dispatched_job': num_dispatched_job,
+                                      'num_queued_job': len(fair_queue) if fair_queue is not None else 0,
+                                      'worker -> sink': addr_sink if self.num_sink > 1 else addr_sink[0],
+                                      'ventilator <-> sink': (addr_front2sink if self.num_sink > 1
+                                                              else addr_front2sink[0]),
                                       'server_current_time': str(datetime.now()),
                                       'statistic': server_status.value,
                                       'device_map': device_map,
-                                      'num_concurrent_socket': self.num_concurrent_socket}
+                                      'num_concurrent_socket': self.num_concurrent_socket,
+                                      'num_inflight_job': len(inflight_jobs),
+                                      'num_inflight_seq': inflight_seq,
+                                      'inflight_size_bytes': inflight_bytes,
+                                      'num_cache_entry': len(self.cache) if self.cache is not None else 0,
+                                      'cache_size_bytes': self.cache.num_bytes if self.cache is not None else 0,
+                                      'sink_memory_bytes': sum(v['num_bytes'] for v in sink_memory),
+                                      'num_sink_job': sum(v['num_job'] for v in sink_memory),
+                                      'num_sink_evicted_job': sum(v['num_evicted_job'] for v in sink_memory),
+                                      'sink_over_budget': sink_full}
 
                     sink.send_multipart([client, msg, jsonapi.dumps({**status_runtime,
                                                                      **self.status_args,
                                                                      **self.status_static}), req_id])
                 else:
-                    self.logger.info('new encode request\treq id: %d\tsize: %d\tclient: %s' %
-                                     (int(req_id), int(msg_len), client))
+                    self.logger.info('new encode request\treq id: %d\tsize: %d\tchunks: %d\tclient: %s' %
+                                     (int(req_id), int(msg_len), len(chunks), client))
+                    job_id = client + b'#' + req_id
+                    num_bytes = sum(len(c) for c in chunks)
+                    if sink_full or (inflight_jobs and ((self.max_inflight_seq and
+                                                         inflight_seq + int(msg_len) > self.max_inflight_seq) or
+                                                        (self.max_inflight_bytes and
+                                                         inflight_bytes + num_bytes > self.max_inflight_bytes))):
+                        # reject fast so that the client can retry later or fail over to another server,
+                        # an idle server always admits a request, no matter how large it is, unless a sink
+                        # is over its memory budget
+                        self.logger.warning('server busy, reject request\treq id: %d\tsize: %d\tclient: %s' %
+                                            (int(req_id), int(msg_len), client))
+                        server_status.update_rejected()
+                        sink.send_multipart([client, ServerCmd.busy,
+                                             jsonapi.dumps({'num_inflight_seq': inflight_seq,
+                                                            'inflight_size_bytes': inflight_bytes,
+                                                            'max_inflight_seq': self.max_inflight_seq,
+                                                            'max_inflight_size_bytes': self.max_inflight_bytes,
+                                                            'sink_over_budget': sink_full}),
+                                             req_id])
+                        continue
+                    if int(msg_len):
+                        inflight_jobs[job_id] = int(msg_len), num_bytes
+                        inflight_seq += int(msg_len)
+                        inflight_bytes += num_bytes
+                    job_info = {}
+                    # the deadline is counted from the arrival at the server
+                    deadline = time.time() + timeout / 1000 if timeout else None
+                    # the job info sent to workers along with every batch of this job
+                    worker_info = {}
+                    if deadline:
+                        job_info['deadline'] = worker_info['deadline'] = deadline
+                    if req_info.get('stream'):
+                        # the sink sends each part to the client once it is done
+                        job_info['stream'] = True
+                    elif self.args.shared_memory:
+                        # workers write the results into the shared memory buffer of this size
+                        worker_info['job_size'] = int(msg_len)
+                    cached = None
+                    if 'id_len' in req_info:
+                        pass
+                    elif self.cache is not None or (self.length_bucketing and int(msg_len) > self.max_batch_size):
+                        seqs = list(chain.from_iterable(jsonapi.loads(c) for c in chunks))
+                        order = list(range(len(seqs)))
+                        if self.cache is not None:
+                            # only the cache misses are sent to workers, the cached embeddings are
+                            # sent to the sink directly and placed after the misses
+                            keys = [self.cache.key(v) for v in seqs]
+                            order, cached = self._lookup_cache(keys, server_status)
+                            seqs = [seqs[i] for i in order[:(len(seqs) - len(cached))]]
+                        if self.length_bucketing and len(seqs) > self.max_batch_size:
+                            # group sequences of similar length into the same batch to reduce padding
+                            seqs, sorted_idx = self._sort_by_length(seqs, server_status)
+                            order[:len(seqs)] = [order[i] for i in sorted_idx]
+                        if self.cache is not None and seqs:
+                            # nothing is sent back for caching if all sequences are hits
+                            pending_cache[job_id] = [keys[i] for i in order[:len(seqs)]]
+                            job_info['num_cache_miss'] = len(seqs)
+                        if order != sorted(order):
+                            # the sink restores the original order
+                            job_info['order'] = order
+                        if len(seqs) > self.max_batch_size:
+                            chunks, chunk_sizes = [seqs], [len(seqs)]
+                        else:
+                            msg = jsonapi.dumps(seqs)
+                            chunks, chunk_sizes = [msg], [len(seqs)]
+
+                    if self.args.sink_job_ttl and sum(chunk_sizes):
+                        # the sink does not count the ttl of the job until all of its parts are dispatched
+                        job_info['queued'] = True
                     # register a new job at sink
-                    sink.send_multipart([client, ServerCmd.new_job, msg_len, req_id])
+                    sink.send_multipart([client, ServerCmd.new_job, msg_len, req_id, jsonapi.dumps(job_info)])
+                    if cached:
+                        self.logger.info('cache hit\tsize: %d\tjob id: %s' % (len(cached), job_id))
+                        sink.send_multipart([client, ServerCmd.data_embed,
+                                             jsonapi.dumps({'dtype': str(cached[0].dtype),
+                                                            'shape': (len(cached),) + cached[0].shape,
+                                                            'partial_id': int(msg_len) - len(cached)}),
+                                             req_id, np.stack(cached)])
 
                     # renew the backend socket to prevent large job queueing up
                     # [0] is reserved for high priority job
@@ -203,20 +546,156 @@ class BertServer(threading.Thread):
 
                     # push a new job, note super large job will be pushed to one socket only,
                     # leaving other sockets free
-                    job_id = client + b'#' + req_id
-                    if int(msg_len) > self.max_batch_size:
-                        seqs = jsonapi.loads(msg)
-                        job_gen = ((job_id + b'@%d' % i, seqs[i:(i + self.max_batch_size)]) for i in
-                                   range(0, int(msg_len), self.max_batch_size))
-                        for partial_job_id, job in job_gen:
-                            push_new_job(partial_job_id, jsonapi.dumps(job), len(job))
+                    num_seq = sum(chunk_sizes)
+                    if not num_seq:
+                        continue
+                    undispatched[job_id] += 1
+                    # the estimated tokens of each sequence of a job that may fit into one batch, for the token budget
+                    seq_lens = None
+                    if (self.max_tokens_per_batch and 'id_len' not in req_info
+                            and len(chunks) == 1 and num_seq <= self.max_batch_size):
+                        seq_lens, seqs = self._estimate_seq_lens(chunks[0], num_seq)
+                        if seqs is not None:
+                            # the job is split with the decoded sequences, not decoded again
+                            chunks = [seqs]
+                    if 'id_len' in req_info:
+                        # token ids are split into batches without decoding them, and skip the micro-batch
+                        for partial_job_id, job, job_len, id_len in self._split_ids_job(
+                                job_id, msg, req_info['id_len'], req_info.get('segment_ids')):
+                            undispatched[job_id] += 1
+                            push_new_job(partial_job_id, job, job_len,
+                                         dict(worker_info, id_len=id_len, segment_ids=req_info.get('segment_ids')))
+                    elif (len(chunks) > 1 or num_seq > self.max_batch_size
+                          or (seq_lens and len(self._get_batch_starts(seq_lens)) > 1)):
+                        for partial_job_id, job, job_len in self._split_job(job_id, chunks, chunk_sizes):
+                            undispatched[job_id] += 1
+                            push_new_job(partial_job_id, job, job_len, worker_info)
+                    elif (self.args.micro_batch and num_seq < self.max_batch_size
+                          and not micro_batch.is_tokenized(msg)):
+                        # merge small jobs from different clients into one batch
+                        if (micro_batch.size + num_seq > self.max_batch_size
+                                or (seq_lens and len(self._get_batch_starts(micro_batch.seq_lens + seq_lens)) > 1)):
+                            flush_micro_batch()
+                        undispatched[job_id] += 1
+                        micro_batch.add(job_id, msg, num_seq, deadline, seq_lens)
+                        if micro_batch.is_full:
+                            flush_micro_batch()
                     else:
-                        push_new_job(job_id, msg, int(msg_len))
+                        undispatched[job_id] += 1
+                        push_new_job(job_id, msg, num_seq, worker_info)
+                    # all parts are pushed, release the extra count
+                    mark_dispatched(job_id)
 
         for p in self.processes:
             p.close()
         self.logger.info('terminated!')
 
+    @staticmethod
+    def _is_int_list(value, min_value):
+        # a list of ints from the request info, bools are ints in python but not valid here
+        return isinstance(value, list) and all(isinstance(n, int) and not isinstance(n, bool) and n >= min_value
+                                               for n in value)
+
+    def _split_job(self, job_id, chunks, chunk_sizes):
+        # chunks that fit into a batch are forwarded as they are, without decoding the JSON
+        offset = 0
+        for chunk, size in zip(chunks, chunk_sizes):
+            seqs = chunk if isinstance(chunk, list) else None
+            if self.max_tokens_per_batch:
+                seq_lens, seqs = self._estimate_seq_lens(chunk, size)
+                starts = self._get_batch_starts(seq_lens)
+            else:
+                starts = list(range(0, size, self.max_batch_size))
+            if len(starts) > 1:
+                seqs = seqs or jsonapi.loads(chunk)
+                for i, j in zip(starts, starts[1:] + [size]):
+                    yield job_id + b'@%d' % (offset + i), jsonapi.dumps(seqs[i:j]), j - i
+            else:
+                yield job_id + b'@%d' % offset, jsonapi.dumps(chunk) if isinstance(chunk, list) else chunk, size
+            offset += size
+
+    def _split_ids_job(self, job_id, msg, id_len, has_segment_ids):
+        # the int32 ids of all sentences, followed by their segment ids if given
+        ids = np.frombuffer(msg, dtype=np.int32)
+        offsets = np.cumsum([0] + id_len).tolist()
+        if self.max_tokens_per_batch:
+            # the exact number of tokens is known, long sentences are trimmed by the workers
+            max_len = self.max_seq_len or self.bert_config.max_position_embeddings
+            starts = self._get_batch_starts([min(n, max_len) for n in id_len])
+        else:
+            starts = list(range(0, len(id_len), self.max_batch_size))
+        for i, j in zip(starts, starts[1:] + [len(id_len)]):
+            job = ids[offsets[i]:offsets[j]]
+            if has_segment_ids:
+                job = np.concatenate([job, ids[(offsets[-1] + offsets[i]):(offsets[-1] + offsets[j])]])
+            yield job_id + b'@%d' % i if len(starts) > 1 else job_id, job.tobytes(), j - i, id_len[i:j]
+
+    def _estimate_seq_lens(self, job, size):
+        # the estimated number of tokens of each sequence of a job, and its decoded sequences if any.
+        # With a fixed "max_seq_len" every sequence is padded to it anyway, so the JSON is not decoded
+        if self.max_seq_len is not None and not self.args.sliding_window:
+            return [self.max_seq_len] * size, job if isinstance(job, list) else None
+        seqs = job if isinstance(job, list) else jsonapi.loads(job)
+        return [estimate_num_tokens(s) for s in seqs], seqs
+
+    def _estimate_rows(self, seq_len):
+        # the number of rows and the padded length of a sequence in a worker batch
+        from .bert.extract_features import get_bucket_length
+        max_len = self.max_seq_len or self.bert_config.max_position_embeddings
+        row_len = self.max_seq_len or get_bucket_length(min(seq_len, max_len), self.padding_buckets)
+        if self.args.sliding_window and seq_len > row_len:
+            # same windows as `convert_lst_to_windows`
+            size = row_len - 2
+            stride = min(self.args.window_stride or max(size // 2, 1), size)
+            return -(-(seq_len - row_len) // stride) + 1, row_len
+        return 1, row_len
+
+    def _get_batch_starts(self, seq_lens):
+        # a batch takes the following sequences as long as it has at most "max_batch_size" sequences and
+        # "max_tokens_per_batch" tokens including the padding, a sequence over the budget is a batch on its own
+        starts, size, num_row, row_len = [], 0, 0, 0
+        for idx, n in enumerate(seq_lens):
+            n_row, n_len = self._estimate_rows(n)
+            if (starts and size < self.max_batch_size
+                    and (num_row + n_row) * max(row_len, n_len) <= self.max_tokens_per_batch):
+                size, num_row, row_len = size + 1, num_row + n_row, max(row_len, n_len)
+            else:
+                starts.append(idx)
+                size, num_row, row_len = 1, n_row, n_len
+        return starts
+
+    def _lookup_cache(self, keys, server_status):
+        miss_idx, hit_idx, hits = [], [], []
+        for idx, k in enumerate(keys):
+            v = self.cache.get(k)
+            if v is None:
+                miss_idx.append(idx)
+            else:
+                hit_idx.append(idx)
+                hits.append(v)
+        server_status.update_cache(num_hit=len(hit_idx), num_miss=len(miss_idx))
+        return miss_idx + hit_idx, hits
+
+    def _sort_by_length(self, seqs, server_status):
+        seq_lens = np.array([estimate_num_tokens(s) for s in seqs])
+        order = np.argsort(seq_lens, kind='stable')
+        # estimate the padded size of all batches before and after sorting
+        batch_starts = np.arange(0, len(seqs), self.max_batch_size)
+        batch_sizes = np.diff(np.append(batch_starts, len(seqs)))
+        padded_before = int(np.sum(np.maximum.reduceat(seq_lens, batch_starts) * batch_sizes))
+        padded_after = int(np.sum(np.maximum.reduceat(seq_lens[order], batch_starts) * batch_sizes))
+        server_status.update_length_bucketing(padded_before, padded_after)
+        self.logger.info('sort by length\tpadding saved: %.2f%%' % (100 * (1 - padded_after / padded_before)))
+        return [seqs[i] for i in order], order.tolist()
+
+    @property
+    def vocab(self):
+        # the vocabulary in JSON for clients that map token ids to strings, loaded at the first request
+        if self._vocab is None:
+            from .bert.tokenization import load_vocab
+            self._vocab = jsonapi.dumps(list(load_vocab(os.path.join(self.model_dir, 'vocab.txt'))))
+        return self._vocab
+
     def _get_device_map(self):
         self.logger.info('get devices')
         run_on_gpu = False
@@ -256,17 +735,26 @@ class BertServer(threading.Thread):
 
 
 class BertSink(Process):
-    def __init__(self, args, front_sink_addr, bert_config):
+    def __init__(self, args, front_sink_addr, bert_config, sink_id=0):
         super().__init__()
+        self.sink_id = sink_id
+        self.num_sink = args.num_sink
+        self.name = 'SINK-%d' % sink_id if self.num_sink > 1 else 'SINK'
         self.port = args.port_out
         self.exit_flag = multiprocessing.Event()
-        self.logger = set_logger(colored('SINK', 'green'), args.verbose)
+        self.logger = set_logger(colored(self.name, 'green'), args.verbose)
         self.front_sink_addr = front_sink_addr
         self.verbose = args.verbose
         self.show_tokens_to_client = args.show_tokens_to_client
         self.max_seq_len = args.max_seq_len
         self.max_position_embeddings = bert_config.max_position_embeddings
         self.fixed_embed_length = args.fixed_embed_length
+        self.shared_memory = args.shared_memory
+        self.ragged_output = args.ragged_output
+        self.compact_tokens = args.compact_tokens
+        self.router_result = args.router_result
+        self.sink_memory = int(args.sink_memory * 1024 * 1024)
+        self.sink_job_ttl = args.sink_job_ttl
         self.is_ready = multiprocessing.Event()
 
     def close(self):
@@ -275,91 +763,290 @@ class BertSink(Process):
         self.exit_flag.set()
         self.terminate()
         self.join()
+        if self.shared_memory:
+            clear_shm_arrays(self.port)
         self.logger.info('terminated!')
 
+    @staticmethod
+    def get_sink_id(job_id, num_sink):
+        # jobs are partitioned among sinks by the hash of "client#req_id", partial ids are ignored
+        return zlib.crc32(job_id.split(b'@')[0]) % num_sink if num_sink > 1 else 0
+
     def run(self):
         self._run()
 
     @zmqd.socket(zmq.PULL)
     @zmqd.socket(zmq.PAIR)
     @zmqd.socket(zmq.PUB)
-    def _run(self, receiver, frontend, sender):
+    @zmqd.socket(zmq.ROUTER)
+    @zmqd.socket(zmq.PUSH)
+    def _run(self, receiver, frontend, publisher, router, result_pusher):
         receiver_addr = auto_bind(receiver)
         frontend.connect(self.front_sink_addr)
-        sender.bind('tcp://*:%d' % self.port)
+        # with several sinks, results are pushed to the result proxy, which owns "port_out"
+        result_addr = auto_bind(result_pusher) if self.num_sink > 1 else ''
 
+        memory = SinkMemory(self.sink_memory)
         pending_jobs = defaultdict(lambda: SinkJob(self.max_seq_len, self.max_position_embeddings,
                                                    self.show_tokens_to_client,
-                                                   self.fixed_embed_length))  # type: Dict[str, SinkJob]
+                                                   self.fixed_embed_length,
+                                                   self.ragged_output,
+                                                   self.compact_tokens,
+                                                   memory))  # type: Dict[str, SinkJob]
+
+        def send_finished(job_info):
+            # only the job that just got new data can be finished, no need to scan all pending jobs
+            tmp = pending_jobs.get(job_info)
+            if tmp is not None and tmp.stream:
+                send_stream_parts(job_info, tmp)
+            elif tmp is not None and tmp.is_done:
+                client_addr, req_id = job_info.split(b'#')
+                x, x_info, token_ids = tmp.result
+                # token ids in compact mode are sent in their own frame after the embeddings
+                send_result([client_addr, x_info, x] + ([token_ids] if token_ids is not None else []) + [req_id])
+                logger.info('send back\tsize: %d\tjob id: %s' % (tmp.checksum, job_info))
+                if tmp.num_cache_miss:
+                    # send the newly computed embeddings back to the ventilator for caching
+                    x = tmp.final_ndarray[:tmp.num_cache_miss]
+                    frontend.send_multipart([client_addr, ServerCmd.data_embed,
+                                             jsonapi.dumps({'dtype': str(x.dtype), 'shape': x.shape}), req_id, x])
+                else:
+                    # tell the ventilator that the job is no longer in flight
+                    frontend.send_multipart([client_addr, ServerCmd.job_done, b'', req_id])
+                # release the job
+                tmp.clear()
+                pending_jobs.pop(job_info)
+
+        def send_stream_parts(job_info, tmp):
+            # forward the finished parts of a streamed job right away, they are not kept in the sink
+            client_addr, req_id = job_info.split(b'#')
+            for pid, x, x_info, token_ids in tmp.pop_stream_parts():
+                send_result([client_addr, x_info, x] + ([token_ids] if token_ids is not None else []) + [req_id])
+                logger.info('send back part\tsize: %d\toffset: %d\tjob id: %s' % (len(x), pid, job_info))
+                if pid < tmp.num_cache_miss:
+                    # newly computed embeddings are cached by the ventilator part by part
+                    frontend.send_multipart([client_addr, ServerCmd.data_embed,
+                                             jsonapi.dumps({'dtype': str(x.dtype), 'shape': x.shape,
+                                                            'partial_id': pid}), req_id, x])
+            if tmp.is_done:
+                frontend.send_multipart([client_addr, ServerCmd.job_done, b'', req_id])
+                tmp.clear()
+                pending_jobs.pop(job_info)
+
+        def drop_job(job_info, reason):
+            tmp = pending_jobs.pop(job_info, None)
+            if tmp is not None:
+                logger.warning('drop job\treason: %s\tprogress: %d/%d\tjob id: %s' % (
+                    reason, tmp.progress_embeds, tmp.checksum, job_info))
+                # let the ventilator release the job and forget its cache keys
+                client_addr, req_id = job_info.split(b'#')
+                frontend.send_multipart([client_addr, ServerCmd.cancel, b'', req_id])
+                tmp.clear()
+            # results of this job that are still in the pipeline will be ignored
+            dropped[job_info] = None
+            if len(dropped) > _max_num_dropped_job:
+                dropped.popitem(last=False)
+
+        def check_memory():
+            if self.sink_job_ttl:
+                # a job that gets no result for a long time after its dispatch is abandoned, e.g. its worker died
+                expired = time.time() - self.sink_job_ttl
+                for job_info in [k for k, v in pending_jobs.items() if not v.queued and v.last_active < expired]:
+                    drop_job(job_info, 'no result for %d seconds' % self.sink_job_ttl)
+                    memory.num_evicted_job += 1
+            # the results held for unconnected clients are reported, but they do not count against the budget
+            num_bytes = memory.num_bytes + (result_sender.num_bytes if result_sender is not None else 0)
+            # report to the ventilator for the server status, and at once when the budget is crossed
+            if memory.check(memory.num_bytes) or (num_bytes, len(pending_jobs)) != memory.last_report:
+                frontend.send_multipart([b'', ServerCmd.sink_memory,
+                                         jsonapi.dumps({'num_bytes': num_bytes,
+                                                        'num_job': len(pending_jobs),
+                                                        'num_evicted_job': memory.num_evicted_job,
+                                                        'is_full': memory.is_full}), b''])
+                memory.last_report = num_bytes, len(pending_jobs)
+
+        # ids of the dropped jobs, and a heap of (deadline, job id) of the pending jobs
+        dropped = OrderedDict()
+        deadlines = []
 
         poller = zmq.Poller()
         poller.register(frontend, zmq.POLLIN)
         poller.register(receiver, zmq.POLLIN)
 
-        # send worker receiver address back to frontend
+        # send worker receiver address and result address back to frontend
         frontend.send(receiver_addr.encode('ascii'))
+        frontend.send(result_addr.encode('ascii'))
 
         # Windows does not support logger in MP environment, thus get a new logger
         # inside the process for better compability
-        logger = set_logger(colored('SINK', 'green'), self.verbose)
+        logger = set_logger(colored(self.name, 'green'), self.verbose)
+
+        result_sender = None
+        if self.num_sink > 1:
+            send_result = result_pusher.send_multipart
+        else:
+            result_sender = ResultSender(router if self.router_result else publisher, self.port,
+                                         self.router_result, logger)
+            send_result = result_sender.send
+            if self.router_result:
+                poller.register(result_sender.sock, zmq.POLLIN)
         logger.info('ready')
         self.is_ready.set()
 
+        next_check = time.time()
         while not self.exit_flag.is_set():
-            socks = dict(poller.poll())
+            # report at once when the budget is crossed either way, otherwise from time to time
+            if next_check <= time.time() or memory.is_over(memory.num_bytes) != memory.is_full:
+                check_memory()
+                next_check = time.time() + _sink_report_interval
+            poll_until = min(deadlines[0][0], next_check) if deadlines else next_check
+            socks = dict(poller.poll(max(0, int((poll_until - time.time()) * 1000))))
+            while deadlines and deadlines[0][0] <= time.time():
+                _, job_info = heapq.heappop(deadlines)
+                if job_info in pending_jobs:
+                    drop_job(job_info, 'deadline exceeded')
+            if result_sender is not None:
+                result_sender.expire()
+                if socks.get(result_sender.sock) == zmq.POLLIN:
+                    result_sender.recv_hello()
             if socks.get(receiver) == zmq.POLLIN:
                 msg = receiver.recv_multipart()
-                job_id = msg[0]
-                # parsing job_id and partial_id
-                job_info = job_id.split(b'@')
-                job_id = job_info[0]
-                partial_id = int(job_info[1]) if len(job_info) == 2 else 0
-
                 if msg[3] == ServerCmd.data_embed:
                     # parsing the ndarray
                     arr_info, arr_val = jsonapi.loads(msg[1]), msg[2]
                     x = np.frombuffer(memoryview(arr_val), dtype=arr_info['dtype']).reshape(arr_info['shape'])
-                    pending_jobs[job_id].add_embed(x, partial_id)
+                    # in ragged output, the rows are the tokens of the sentences without padding
+                    seq_len = arr_info.get('seq_len')
                 elif msg[3] == ServerCmd.data_token:
                     x = jsonapi.loads(msg[1])
-                    pending_jobs[job_id].add_token(x, partial_id)
+                    seq_len = None
+                elif msg[3] == ServerCmd.data_token_ids:
+                    # the token ids of all sentences without padding, plus the number of tokens of each sentence
+                    arr_info = jsonapi.loads(msg[1])
+                    x = np.frombuffer(memoryview(msg[2]), dtype=arr_info['dtype'])
+                    seq_len = arr_info['seq_len']
+                elif msg[3] == ServerCmd.data_embed_shm:
+                    # the worker has written the rows into the shared memory buffer of the job
+                    job_id, _, partial_id = msg[0].partition(b'@')
+                    arr_info = jsonapi.loads(msg[1])
+                    if job_id in dropped:
+                        remove_shm_array(get_shm_path(self.port, job_id))
+                        continue
+                    tmp = pending_jobs[job_id]
+                    tmp.shm_path = get_shm_path(self.port, job_id)
+                    tmp.add_shm_embed(int(partial_id or 0), arr_info['shape'], arr_info['dtype'],
+                                      arr_info['buffer_shape'])
+                    logger.info('collect %s %s (E:%d/T:%d/A:%d)' % (msg[3], job_id, tmp.progress_embeds,
+                                                                    tmp.progress_tokens, tmp.checksum))
+                    send_finished(job_id)
+                    continue
                 else:
                     logger.error('received a wrongly-formatted request (expected 4 frames, got %d)' % len(msg))
                     logger.error('\n'.join('field %d: %s' % (idx, k) for idx, k in enumerate(msg)), exc_info=True)
+                    continue
+
+                # a micro-batch carries the results of several jobs, split them by their sizes
+                for job_id, offset, size in MicroBatch.split(msg[0]):
+                    # parsing job_id and partial_id
+                    job_info = job_id.split(b'@')
+                    job_id = job_info[0]
+                    partial_id = int(job_info[1]) if len(job_info) == 2 else 0
+                    part_len = None
+                    if seq_len is not None:
+                        part_len = seq_len[offset:(offset + size)] if size else seq_len
+                        token_offset = sum(seq_len[:offset])
+                        x_part = x[token_offset:(token_offset + sum(part_len))]
+                    else:
+                        x_part = x[offset:(offset + size)] if size else x
+                    if job_id in dropped:
+                        continue
+                    if self.num_sink > 1 and self.get_sink_id(job_id, self.num_sink) != self.sink_id:
+                        # a micro-batch is sent to all sinks of its jobs, this job belongs to another sink
+                        continue
+
+                    tmp = pending_jobs[job_id]
+                    if msg[3] == ServerCmd.data_embed:
+                        tmp.add_embed(x_part, partial_id, part_len)
+                    else:
+                        tmp.add_token(x_part, partial_id, part_len)
 
-                logger.info('collect %s %s (E:%d/T:%d/A:%d)' % (msg[3], job_id,
-                                                                pending_jobs[job_id].progress_embeds,
-                                                                pending_jobs[job_id].progress_tokens,
-                                                                pending_jobs[job_id].checksum))
-
-                # check if there are finished jobs, then send it back to workers
+                    logger.info('collect %s %s (E:%d/T:%d/A:%d)' % (msg[3], job_id, tmp.progress_embeds,
+                                                                    tmp.progress_tokens, tmp.checksum))
 
-                finished = [(k, v) for k, v in pending_jobs.items() if v.is_done]
-                for job_info, tmp in finished:
-                    client_addr, req_id = job_info.split(b'#')
-                    x, x_info = tmp.result
-                    sender.send_multipart([client_addr, x_info, x, req_id])
-                    logger.info('send back\tsize: %d\tjob id: %s' % (tmp.checksum, job_info))
-                    # release the job
-                    tmp.clear()
-                    pending_jobs.pop(job_info)
+                    # check if the job is finished, then send it back to the client
+                    send_finished(job_id)
 
             if socks.get(frontend) == zmq.POLLIN:
-                client_addr, msg_type, msg_info, req_id = frontend.recv_multipart()
+                client_addr, msg_type, msg_info, req_id, *extra = frontend.recv_multipart()
                 if msg_type == ServerCmd.new_job:
                     job_info = client_addr + b'#' + req_id
-                    # register a new job
-                    pending_jobs[job_info].checksum = int(msg_info)
+                    job_args = jsonapi.loads(extra[0])
+                    deadline = job_args.pop('deadline', None)
+                    if deadline:
+                        heapq.heappush(deadlines, (deadline, job_info))
+                    if self.shared_memory and not job_args.get('stream'):
+                        # the final result is assembled in shared memory, where workers write their rows
+                        pending_jobs[job_info].shm_path = get_shm_path(self.port, job_info)
+                    # register a new job, its results may already arrive before the registration
+                    pending_jobs[job_info].register(int(msg_info), **job_args)
                     logger.info('job register\tsize: %d\tjob id: %s' % (int(msg_info), job_info))
-                elif msg_type == ServerCmd.show_config:
-                    time.sleep(0.1)  # dirty fix of slow-joiner: sleep so that client receiver can connect.
-                    logger.info('send config\tclient %s' % client_addr)
-                    sender.send_multipart([client_addr, msg_info, req_id])
+                    send_finished(job_info)
+                elif msg_type == ServerCmd.cancel:
+                    drop_job(client_addr + b'#' + req_id, 'cancelled by the client')
+                elif msg_type == ServerCmd.job_dispatched:
+                    # all parts of the job have left the queues of the ventilator, start counting its ttl
+                    tmp = pending_jobs.get(client_addr + b'#' + req_id)
+                    if tmp is not None:
+                        tmp.queued = False
+                        tmp.last_active = time.time()
+                elif msg_type == ServerCmd.busy:
+                    logger.info('send busy\tclient %s' % client_addr)
+                    send_result([client_addr, msg_type, msg_info, req_id])
+                elif msg_type == ServerCmd.data_embed:
+                    # cached embeddings from the ventilator
+                    job_info = client_addr + b'#' + req_id
+                    arr_info = jsonapi.loads(msg_info)
+                    x = np.frombuffer(memoryview(extra[0]), dtype=arr_info['dtype']).reshape(arr_info['shape'])
+                    pending_jobs[job_info].add_embed(x, arr_info['partial_id'])
+                    send_finished(job_info)
+                elif msg_type in (ServerCmd.show_config, ServerCmd.show_vocab):
+                    if not self.router_result:
+                        time.sleep(0.1)  # dirty fix of slow-joiner: sleep so that client receiver can connect.
+                    logger.info('send %s\tclient %s' % ('config' if msg_type == ServerCmd.show_config else 'vocab',
+                                                       client_addr))
+                    send_result([client_addr, msg_info, req_id])
+
+
+class SinkMemory:
+    """Counts the bytes held by the pending jobs of a sink, against the budget of "sink_memory"
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.num_bytes = 0
+        self.num_evicted_job = 0
+        self.is_full = False
+        self.last_report = None
+
+    def is_over(self, num_bytes):
+        # once full, the sink waits until the memory drops well below the budget, so that it does not flip-flop
+        return bool(self.budget) and num_bytes > self.budget * (_sink_resume_ratio if self.is_full else 1)
+
+    def check(self, num_bytes):
+        """update the state by the current memory, return True if it changes"""
+        is_full = self.is_over(num_bytes)
+        changed, self.is_full = is_full != self.is_full, is_full
+        return changed
 
 
 class SinkJob:
-    def __init__(self, max_seq_len, max_position_embeddings, with_tokens, fixed_embed_length):
+    def __init__(self, max_seq_len, max_position_embeddings, with_tokens, fixed_embed_length, ragged_output=False,
+                 compact_tokens=False, memory=None):
         self._pending_embeds = []
+        self.embeds = []
+        self.embeds_ids = []
+        self.ragged_output = ragged_output
+        self.compact_tokens = compact_tokens
         self.tokens = []
         self.tokens_ids = []
         self.checksum = 0
@@ -371,12 +1058,53 @@ class SinkJob:
         self.max_position_embeddings = max_position_embeddings
         self.max_effective_len = 0
         self.fixed_embed_length = fixed_embed_length
+        self.order = None
+        self.num_cache_miss = 0
+        self.shm_path = None
+        self.stream = False
+        # the bytes held by this job, they are also counted in the memory of the sink
+        self.num_bytes = 0
+        self.memory = memory
+        self.last_active = time.time()
+        # some parts are still waiting in the ventilator, the job can not be abandoned yet
+        self.queued = False
+
+    def _add_bytes(self, num_bytes):
+        self.num_bytes += num_bytes
+        if self.memory is not None:
+            self.memory.num_bytes += num_bytes
+
+    @staticmethod
+    def _token_bytes(tokens):
+        # token ids are an ndarray, token strings are counted by their lengths
+        return tokens.nbytes if isinstance(tokens, np.ndarray) else sum(len(t) for t in tokens)
 
     def clear(self):
+        self._add_bytes(-self.num_bytes)
         self._pending_embeds.clear()
+        self.embeds.clear()
+        self.embeds_ids.clear()
         self.tokens_ids.clear()
         self.tokens.clear()
         del self.final_ndarray
+        if self.shm_path:
+            remove_shm_array(self.shm_path)
+
+    def register(self, checksum, order=None, num_cache_miss=0, stream=False, queued=False):
+        self.checksum = checksum
+        # the sequences were reordered by the ventilator, row i of the result is the sequence order[i]
+        self.order = order
+        # the first rows are computed by workers and should be cached by the ventilator
+        self.num_cache_miss = num_cache_miss
+        # the parts are sent to the client one by one instead of being assembled
+        self.stream = stream
+        self.queued = queued
+        self.last_active = time.time()
+        # fill in the embeddings that arrived before the registration
+        while self._pending_embeds:
+            data, pid, _ = self._pending_embeds.pop()
+            self._add_bytes(-data.nbytes)
+            self.add_embed(data, pid)
 
     def _insert(self, data, pid, data_lst, idx_lst):
         lo = 0
@@ -390,7 +1118,16 @@ class SinkJob:
         idx_lst.insert(lo, pid)
         data_lst.insert(lo, data)
 
-    def add_embed(self, data, pid):
+    def add_embed(self, data, pid, seq_len=None):
+        self.last_active = time.time()
+        if self.ragged_output or self.stream:
+            # in ragged output, the tokens of len(seq_len) sentences without padding are concatenated at the end,
+            # in streaming, the parts are kept as they are until they are sent
+            self._insert((data, seq_len), pid, self.embeds, self.embeds_ids)
+            self.progress_embeds += len(seq_len) if seq_len is not None else data.shape[0]
+            self._add_bytes(data.nbytes)
+            return
+
         def fill_data():
             self.final_ndarray[pid: (pid + data.shape[0]), 0:data.shape[1]] = data
             self.progress_embeds += progress
@@ -400,6 +1137,7 @@ class SinkJob:
         progress = data.shape[0]
         if not self.checksum:
             self._pending_embeds.append((data, pid, progress))
+            self._add_bytes(data.nbytes)
         else:
             if self.final_ndarray is None:
                 d_shape = list(data.shape[1:])
@@ -407,13 +1145,72 @@ class SinkJob:
                     # if not set max_seq_len, then we have no choice but set result ndarray to
                     # [B, max_position_embeddings, dim] and truncate it at the end
                     d_shape[0] = self.max_position_embeddings
-                self.final_ndarray = np.zeros([self.checksum] + d_shape, dtype=data.dtype)
+                if self.shm_path:
+                    self.final_ndarray = open_shm_array(self.shm_path, data.dtype, [self.checksum] + d_shape)
+                else:
+                    self.final_ndarray = np.zeros([self.checksum] + d_shape, dtype=data.dtype)
+                self._add_bytes(self.final_ndarray.nbytes)
             fill_data()
             while self._pending_embeds:
                 data, pid, progress = self._pending_embeds.pop()
+                self._add_bytes(-data.nbytes)
                 fill_data()
 
-    def add_token(self, data, pid):
+    def add_shm_embed(self, pid, data_shape, dtype, buffer_shape):
+        # the rows are already written into the shared memory buffer by a worker, nothing to copy
+        self.last_active = time.time()
+        if self.final_ndarray is None:
+            self.final_ndarray = open_shm_array(self.shm_path, dtype, buffer_shape)
+            self._add_bytes(self.final_ndarray.nbytes)
+        self.progress_embeds += data_shape[0]
+        if data_shape[1] > self.max_effective_len:
+            self.max_effective_len = data_shape[1]
+
+    def pop_stream_parts(self):
+        # a part is ready once its embeddings, and its tokens if required, have arrived
+        ready = [i for i, pid in enumerate(self.embeds_ids) if not self.with_tokens or pid in self.tokens_ids]
+        parts = []
+        for i in reversed(ready):
+            pid, (x, seq_len) = self.embeds_ids.pop(i), self.embeds.pop(i)
+            self._add_bytes(-x.nbytes)
+            tokens = ''
+            if self.with_tokens:
+                j = self.tokens_ids.index(pid)
+                self.tokens_ids.pop(j)
+                tokens = self.tokens.pop(j)
+                self._add_bytes(-self._token_bytes(tokens[0] if self.compact_tokens else tokens))
+            if self.max_seq_len_unset and self.fixed_embed_length and x.ndim > 2:
+                x = np.pad(x, [(0, 0), (0, self.max_position_embeddings - x.shape[1]), (0, 0)], 'constant')
+            x = np.ascontiguousarray(x)
+            token_ids = None
+            if self.compact_tokens and tokens:
+                token_ids, token_len = tokens
+                tokens = ''
+            x_info = {'dtype': str(x.dtype),
+                      'shape': x.shape,
+                      'tokens': tokens}
+            if token_ids is not None:
+                x_info['token_ids'] = {'dtype': str(token_ids.dtype), 'seq_len': token_len}
+                token_ids = np.ascontiguousarray(token_ids)
+            num_seq = len(seq_len) if seq_len is not None else x.shape[0]
+            if self.order is not None:
+                # the client places the rows by their positions in the original request
+                x_info['index'] = self.order[pid:(pid + num_seq)]
+            else:
+                x_info['offset'] = pid
+            if seq_len is not None:
+                x_info['seq_len'] = seq_len
+            parts.append((pid, x, jsonapi.dumps(x_info), token_ids))
+        return parts
+
+    def add_token(self, data, pid, seq_len=None):
+        self.last_active = time.time()
+        self._add_bytes(self._token_bytes(data))
+        if seq_len is not None:
+            # the token ids of len(seq_len) sentences, they are concatenated at the end
+            self._insert((data, seq_len), pid, self.tokens, self.tokens_ids)
+            self.progress_tokens += len(seq_len)
+            return
         progress = len(data)
         self._insert(data, pid, self.tokens, self.tokens_ids)
         self.progress_tokens += progress
@@ -425,42 +1222,605 @@ class SinkJob:
         else:
             return self.checksum > 0 and self.checksum == self.progress_embeds
 
+    @staticmethod
+    def _concat_ragged(parts, restore=None):
+        # concatenate the (data, seq_len) parts, and restore the original order by gathering the rows of each sentence
+        x = np.concatenate([v[0] for v in parts])
+        seq_len = np.array(list(chain.from_iterable(v[1] for v in parts)), dtype=np.int64)
+        if restore is not None:
+            starts = np.cumsum(seq_len) - seq_len
+            seq_len = seq_len[restore]
+            x = x[np.repeat(starts[restore] - (np.cumsum(seq_len) - seq_len), seq_len) + np.arange(len(x))]
+        return x, seq_len
+
     @property
     def result(self):
-        if self.max_seq_len_unset and not self.fixed_embed_length:
-            x = np.ascontiguousarray(self.final_ndarray[:, 0:self.max_effective_len])
+        restore = np.argsort(self.order) if self.order is not None else None
+        tokens, token_ids = '', None
+        if self.with_tokens and self.compact_tokens:
+            token_ids, token_len = self._concat_ragged(self.tokens, restore)
+        elif self.with_tokens:
+            tokens = list(chain.from_iterable(self.tokens))
+        seq_len = None
+        if self.ragged_output:
+            x, seq_len = self._concat_ragged(self.embeds, restore)
         else:
-            x = self.final_ndarray
+            if self.max_seq_len_unset and not self.fixed_embed_length:
+                x = self.final_ndarray[:, 0:self.max_effective_len]
+            else:
+                x = self.final_ndarray
+            if restore is not None:
+                # restore the original order, fancy indexing also makes x contiguous
+                x = x[restore]
+            else:
+                x = np.ascontiguousarray(x)
+        if tokens and restore is not None:
+            tokens = [tokens[i] for i in restore]
         x_info = {'dtype': str(x.dtype),
                   'shape': x.shape,
-                  'tokens': list(chain.from_iterable(self.tokens)) if self.with_tokens else ''}
+                  'tokens': tokens}
+        if seq_len is not None:
+            x_info['seq_len'] = seq_len.tolist()
+        if token_ids is not None:
+            x_info['token_ids'] = {'dtype': str(token_ids.dtype), 'seq_len': token_len.tolist()}
 
         x_info = jsonapi.dumps(x_info)
-        return x, x_info
+        return x, x_info, token_ids
+
+
+class ResultSender:
+    """Sends results to clients through a PUB socket, or through a ROUTER socket with "router_result"
+
+    Through ROUTER, a result for a client that has not connected yet is held until the client says hello,
+    instead of being dropped.
+    """
+
+    def __init__(self, sock, port, router_result, logger):
+        self.sock = sock
+        self.router_result = router_result
+        self.logger = logger
+        if router_result:
+            # fail instead of dropping a result if the client is unknown, and never drop it at the high-water mark
+            sock.setsockopt(zmq.ROUTER_MANDATORY, 1)
+            sock.setsockopt(zmq.ROUTER_HANDOVER, 1)
+            sock.setsockopt(zmq.SNDHWM, 0)
+        sock.bind('tcp://*:%d' % port)
+        # results for the clients that are not yet connected, in the sending order
+        self._undelivered = {}
+
+    @property
+    def num_bytes(self):
+        return sum(memoryview(f).nbytes for v in self._undelivered.values() for _, frames in v for f in frames)
+
+    def send(self, frames):
+        # frames[0] is the client identity, which the client subscribes to, or is routed by
+        if not self.router_result:
+            self.sock.send_multipart(frames)
+            return
+        client_addr = frames[0]
+        if client_addr not in self._undelivered:
+            try:
+                # the routing frame is consumed by the router, the client gets the same frames as from PUB
+                self.sock.send_multipart([client_addr] + frames)
+                return
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EHOSTUNREACH:
+                    raise
+        self._undelivered.setdefault(client_addr, []).append((time.time(), frames))
+
+    def recv_hello(self):
+        # a client connects to the router and says hello, send the results held for it
+        client_addr = self.sock.recv_multipart()[0]
+        for _, frames in self._undelivered.pop(client_addr, []):
+            self.send(frames)
+
+    def expire(self):
+        for client_addr in [k for k, v in self._undelivered.items() if v[0][0] < time.time() - _max_undelivered_time]:
+            self.logger.warning('drop %d results\treason: client never connected\tclient %s' % (
+                len(self._undelivered.pop(client_addr)), client_addr))
+
+
+class BertResultProxy(Process):
+    def __init__(self, args, sink_result_addrs):
+        super().__init__()
+        self.port = args.port_out
+        self.router_result = args.router_result
+        self.sink_result_addrs = sink_result_addrs
+        self.exit_flag = multiprocessing.Event()
+        self.logger = set_logger(colored('RESULT', 'cyan'), args.verbose)
+        self.verbose = args.verbose
+        self.is_ready = multiprocessing.Event()
+
+    def close(self):
+        self.logger.info('shutting down...')
+        self.is_ready.clear()
+        self.exit_flag.set()
+        self.terminate()
+        self.join()
+        self.logger.info('terminated!')
+
+    def run(self):
+        self._run()
+
+    @zmqd.socket(zmq.PULL)
+    @zmqd.socket(zmq.PUB)
+    @zmqd.socket(zmq.ROUTER)
+    def _run(self, receiver, publisher, router):
+        for addr in self.sink_result_addrs:
+            receiver.connect(addr)
+        logger = set_logger(colored('RESULT', 'cyan'), self.verbose)
+        result_sender = ResultSender(router if self.router_result else publisher, self.port, self.router_result, logger)
+
+        poller = zmq.Poller()
+        poller.register(receiver, zmq.POLLIN)
+        if self.router_result:
+            poller.register(result_sender.sock, zmq.POLLIN)
+        logger.info('ready')
+        self.is_ready.set()
+
+        while not self.exit_flag.is_set():
+            socks = dict(poller.poll())
+            result_sender.expire()
+            if socks.get(result_sender.sock) == zmq.POLLIN:
+                result_sender.recv_hello()
+            if socks.get(receiver) == zmq.POLLIN:
+                # only the client identity is needed for routing, the rest is forwarded without copying
+                frames = receiver.recv_multipart(copy=False)
+                result_sender.send([frames[0].bytes] + frames[1:])
+
+
+class MicroBatch:
+    """Collects small jobs from different clients and merges them into one worker batch.
+
+    The merged batch is identified by the ids of its jobs joined with "|", each suffixed
+    by its size, e.g. "client1#3/2|client2#7/5", so that the sink can split the result.
+    """
+
+    def __init__(self, max_batch_size, timeout):
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout / 1000
+        self.clear()
+
+    def clear(self):
+        self._job_ids = []
+        self._msgs = []
+        self._job_deadlines = []
+        self._seq_lens = []
+        self.size = 0
+        self.deadline = None
+
+    def add(self, job_id, msg, msg_len, job_deadline=None, seq_lens=None):
+        if not self._job_ids:
+            self.deadline = time.perf_counter() + self.timeout
+        self._job_ids.append((job_id, msg_len))
+        self._msgs.append(msg)
+        self._job_deadlines.append(job_deadline)
+        self._seq_lens.append(seq_lens or [])
+        self.size += msg_len
+
+    def remove(self, job_id):
+        for idx, (k, v) in enumerate(self._job_ids):
+            if k == job_id:
+                self._job_ids.pop(idx)
+                self._msgs.pop(idx)
+                self._job_deadlines.pop(idx)
+                self._seq_lens.pop(idx)
+                self.size -= v
+                if not self._job_ids:
+                    self.clear()
+                return
+
+    def pop(self):
+        if len(self._job_ids) == 1:
+            job_id, msg = self._job_ids[0][0], self._msgs[0]
+        else:
+            job_id = b'|'.join(b'%s/%d' % (k, v) for k, v in self._job_ids)
+            # concatenate the JSON lists without decoding them
+            msg = b'[' + b', '.join(m.strip()[1:-1] for m in self._msgs) + b']'
+        # the batch expires only when all of its jobs expire
+        job_deadline = None if None in self._job_deadlines else max(self._job_deadlines)
+        batch = job_id, msg, self.size, len(self._job_ids), job_deadline
+        self.clear()
+        return batch
+
+    @property
+    def is_full(self):
+        return self.size >= self.max_batch_size
+
+    @property
+    def seq_lens(self):
+        # the estimated tokens of each sequence, only known with "max_tokens_per_batch"
+        return list(chain.from_iterable(self._seq_lens))
+
+    @property
+    def time_left(self):
+        # remaining time (ms) before the batch must be flushed, None if the batch is empty
+        if self.deadline is not None:
+            return max(0, int((self.deadline - time.perf_counter()) * 1000))
+
+    @staticmethod
+    def is_tokenized(msg):
+        # a JSON list of lists, which can not be merged with raw strings
+        return msg.lstrip()[1:].lstrip()[:1] == b'['
+
+    @staticmethod
+    def split(job_id):
+        if b'|' not in job_id:
+            return [(job_id, 0, 0)]
+        parts = []
+        offset = 0
+        for part in job_id.split(b'|'):
+            part_id, size = part.rsplit(b'/', 1)
+            parts.append((part_id, offset, int(size)))
+            offset += int(size)
+        return parts
+
+
+class FairQueue:
+    """Queues jobs per client and releases them by weighted fair queuing.
+
+    Every job gets a virtual finish tag, i.e. the finish tag of the previous job of the same client
+    (or the current virtual time if the client was idle) plus the job size divided by the client weight.
+    The job with the smallest tag is released first, so that the batches of a huge request are interleaved
+    with the jobs of other clients. A client with a rate limit is additionally paced by a token bucket.
+    A merged micro-batch is queued on its own, but charged to each of its clients by its number of sequences,
+    so it waits for the latest finish tag and the slowest token bucket among them.
+    """
+
+    def __init__(self, weights, rate_limits, max_batch_size):
+        self.weights = self.parse_client_values(weights)
+        self.rate_limits = self.parse_client_values(rate_limits)
+        self.default_rate_limit = self.rate_limits.pop(None, 0)
+        self.max_batch_size = max_batch_size
+        self.virtual_time = 0
+        self._queues = OrderedDict()  # client -> deque of (finish tag, job)
+        self._last_finish = {}
+        self._buckets = {}  # client -> [number of tokens, last update time]
+
+    def __len__(self):
+        return sum(len(q) for q in self._queues.values())
+
+    @staticmethod
+    def parse_client_values(values):
+        # "identity=value" pairs, a single "value" applies to all clients and is keyed by None
+        result = {}
+        for v in values:
+            k, _, v = v.rpartition('=')
+            result[k.encode('ascii') if k else None] = float(v)
+        return result
+
+    def add(self, client, job_id, msg, msg_len, job_info=None, charges=None):
+        # charges: number of sequences of each client in the job, default is all of them to the queued client
+        charges = charges or {client: msg_len}
+        finish = 0
+        for c, n in charges.items():
+            start = max(self.virtual_time, self._last_finish.get(c, 0))
+            self._last_finish[c] = start + n / self.weights.get(c, 1)
+            finish = max(finish, self._last_finish[c])
+        if client not in self._queues:
+            self._queues[client] = deque()
+        self._queues[client].append((finish, (job_id, msg, msg_len, job_info), charges))
+
+    def remove(self, client, job_id):
+        # remove all queued batches of a job, e.g. when the job is cancelled
+        q = self._queues.get(client)
+        if q:
+            kept = [v for v in q if v[1][0].split(b'@')[0] != job_id]
+            if kept:
+                self._queues[client] = deque(kept)
+            else:
+                self._drop_client(client)
+
+    def pop(self):
+        """returns the next job to release, None if the queue is empty or all clients are rate-limited"""
+        now = time.perf_counter()
+        best = None
+        for client, q in self._queues.items():
+            if not self._charge_wait_time(q[0][2], now) and (best is None or q[0][0] < best[0]):
+                best = q[0][0], client
+        if best is None:
+            return None
+        finish, client = best
+        _, job, charges = self._queues[client].popleft()
+        self.virtual_time = finish
+        for c, n in charges.items():
+            if c in self._buckets:
+                self._buckets[c][0] -= n
+        if not self._queues[client]:
+            self._drop_client(client)
+        return job
+
+    @property
+    def time_left(self):
+        # remaining time (ms) before a rate-limited job can be released, None if no job is rate-limited
+        now = time.perf_counter()
+        waits = [self._charge_wait_time(q[0][2], now) for q in self._queues.values()]
+        waits = [v for v in waits if v]
+        if waits:
+            return max(1, int(min(waits) * 1000))
+
+    def _drop_client(self, client):
+        del self._queues[client]
+        # an idle client restarts from the virtual time, also the clients that were only charged by micro-batches
+        for c in [c for c, finish in self._last_finish.items() if finish <= self.virtual_time]:
+            del self._last_finish[c]
+
+    def _charge_wait_time(self, charges, now):
+        return max(self._wait_time(c, n, now) for c, n in charges.items())
+
+    def _wait_time(self, client, msg_len, now):
+        # refill the token bucket of the client and returns the time (s) before it has enough tokens
+        rate = self.rate_limits.get(client, self.default_rate_limit)
+        if not rate:
+            return 0
+        # allow a burst of one second of sequences, and at least a full batch
+        burst = max(rate, self.max_batch_size)
+        if client not in self._buckets:
+            self._buckets[client] = [burst, now]
+        bucket = self._buckets[client]
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        return max(0, min(msg_len, burst) - bucket[0]) / rate
+
+
+class BertTokenizer(Process):
+    def __init__(self, id, args, worker_address_list, sink_address_list, report_address, cancel_address,
+                 graph_config):
+        super().__init__()
+        self.tokenizer_id = id
+        self.logger = set_logger(colored('TOKENIZER-%d' % self.tokenizer_id, 'blue'), args.verbose)
+        self.args = args
+        self.daemon = True
+        self.exit_flag = multiprocessing.Event()
+        self.worker_address = worker_address_list
+        self.num_concurrent_socket = len(self.worker_address)
+        self.sink_address = sink_address_list
+        self.num_sink = len(self.sink_address)
+        self.report_address = report_address
+        self.cancel_address = cancel_address
+        self.bert_config = graph_config
+        self.verbose = args.verbose
+        self.is_ready = multiprocessing.Event()
+
+    def close(self):
+        self.logger.info('shutting down...')
+        self.exit_flag.set()
+        self.is_ready.clear()
+        self.terminate()
+        self.join()
+        self.logger.info('terminated!')
+
+    def run(self):
+        self._run()
+
+    @zmqd.socket(zmq.PUSH)
+    @zmqd.socket(zmq.PUSH)
+    @zmqd.socket(zmq.SUB)
+    @multi_socket(zmq.PULL, num_socket='num_concurrent_socket')
+    @multi_socket(zmq.PUSH, num_socket='num_sink')
+    def _run(self, sender, report, canceller, *socks):
+        # Windows does not support logger in MP environment, thus get a new logger
+        # inside the process for better compatibility
+        logger = set_logger(colored('TOKENIZER-%d' % self.tokenizer_id, 'blue'), self.verbose)
+        converter = JobConverter(self.args, self.bert_config, logger)
+
+        receivers, sinks = socks[:self.num_concurrent_socket], socks[self.num_concurrent_socket:]
+        for sock, addr in zip(receivers, self.worker_address):
+            sock.connect(addr)
+        for sink, addr in zip(sinks, self.sink_address):
+            sink.connect(addr)
+        report.connect(self.report_address)
+        canceller.setsockopt(zmq.SUBSCRIBE, b'')
+        canceller.connect(self.cancel_address)
+        # workers connect to the address of this tokenizer, which is told to the ventilator through the report socket
+        report.send_multipart([b'%d' % self.tokenizer_id, auto_bind(sender).encode('ascii')])
+
+        logger.info('ready and listening!')
+        self.is_ready.set()
+
+        for _, client_id, job_info, msg, msg_len in JobConverter.receive_jobs(
+                receivers, canceller, report, self.tokenizer_id, self.exit_flag, logger):
+            features, convert_info = converter.convert(client_id, msg, sinks)
+            job_info.update(convert_info)
+            job_info['shape'] = features['input_ids'].shape
+            sender.send_multipart([client_id, jsonapi.dumps(job_info)]
+                                  + [features[k] for k in JobConverter.feature_names])
+            logger.info('job tokenized\tsize: %d\tclient: %s' % (msg_len, client_id))
+
+
+class JobConverter:
+    """Converts the sequences of a job into padded features, and sends the tokens to the sinks if required
+
+    This runs in the workers, or in the tokenizer processes with "num_tokenizer".
+    """
+
+    feature_names = ['input_ids', 'input_mask', 'input_type_ids']
+
+    def __init__(self, args, bert_config, logger):
+        from .bert.extract_features import FeatureBuffer
+        from .bert.tokenization import FullTokenizer
+        # features are written into reused arrays, a batch must not be overwritten while it
+        # waits in the prefetch queue of the worker, or is being run by the model
+        self.buffer = FeatureBuffer(args.prefetch_size + 3)
+        self.packed_buffer = FeatureBuffer(args.prefetch_size + 3) if args.sequence_packing else None
+        self.sliding_window = args.sliding_window
+        self.window_stride = args.window_stride
+        self.tokenizer = FullTokenizer(vocab_file=os.path.join(args.model_dir, 'vocab.txt'),
+                                       do_lower_case=args.do_lower_case)
+        self.max_seq_len = args.max_seq_len
+        self.max_position_embeddings = bert_config.max_position_embeddings
+        self.padding_buckets = get_padding_buckets(args, bert_config)
+        self.mask_cls_sep = args.mask_cls_sep
+        self.show_tokens_to_client = args.show_tokens_to_client
+        self.compact_tokens = args.compact_tokens
+        self.ragged_output = args.ragged_output
+        self.logger = logger
+
+    @classmethod
+    def receive_jobs(cls, socks, canceller, report, proc_id, exit_flag, logger, is_features=False):
+        """yield (socket index, client id, job info, message or features, size) of every job to work on
+
+        A job that nobody waits for is skipped and its size is reported back, so that the ventilator
+        gives back its credit.
+        """
+        poller = zmq.Poller()
+        for sock in socks:
+            poller.register(sock, zmq.POLLIN)
+        poller.register(canceller, zmq.POLLIN)
+        # ids of the jobs cancelled by clients
+        cancelled = OrderedDict()
+
+        while not exit_flag.is_set():
+            events = dict(poller.poll())
+            if canceller in events:
+                cancelled[canceller.recv()] = None
+                if len(cancelled) > _max_num_dropped_job:
+                    cancelled.popitem(last=False)
+            for sock_idx, sock in enumerate(socks):
+                if sock in events:
+                    if is_features:
+                        client_id, job_info, *arrays = sock.recv_multipart()
+                        job_info = jsonapi.loads(job_info)
+                        msg = cls.load_features(job_info, arrays)
+                        msg_len = len(msg['input_ids'])
+                    else:
+                        client_id, raw_msg, *job_info = sock.recv_multipart()
+                        job_info = jsonapi.loads(job_info[0]) if job_info else {}
+                        msg = cls.load_msg(raw_msg, job_info)
+                        msg_len = len(msg)
+                    if cls.is_abandoned(client_id, job_info, cancelled):
+                        # nobody is waiting for the result, skip it and give back the credit
+                        logger.info('skip job\tsize: %d\tclient: %s' % (msg_len, client_id))
+                        report.send_multipart([b'%d' % proc_id, b'%d' % msg_len])
+                        continue
+                    yield sock_idx, client_id, job_info, msg, msg_len
+
+    @staticmethod
+    def is_abandoned(client_id, job_info, cancelled):
+        # the deadline of the job has passed, or all jobs of the micro-batch are cancelled
+        return (job_info.get('deadline', np.inf) < time.time()
+                or all(k.split(b'@')[0] in cancelled for k, _, _ in MicroBatch.split(client_id)))
+
+    @staticmethod
+    def load_msg(raw_msg, job_info):
+        if 'id_len' not in job_info:
+            return jsonapi.loads(raw_msg)
+        # the token ids from "encode_ids", followed by the segment ids if given,
+        # they are returned as a list of (ids, segment ids) of each sentence
+        id_len = job_info.pop('id_len')
+        ids = np.frombuffer(raw_msg, dtype=np.int32)
+        offsets = np.cumsum(id_len)
+        segment_ids = (np.split(ids[offsets[-1]:], offsets[:-1]) if job_info.pop('segment_ids', False)
+                       else [None] * len(id_len))
+        return list(zip(np.split(ids[:offsets[-1]], offsets[:-1]), segment_ids))
+
+    @classmethod
+    def load_features(cls, job_info, arrays):
+        # the features sent by a tokenizer process
+        shape = job_info.pop('shape')
+        return {k: np.frombuffer(v, dtype=np.int32).reshape(shape) for k, v in zip(cls.feature_names, arrays)}
+
+    def convert(self, client_id, msg, sinks):
+        """return the features of the job, and the job info that the worker needs"""
+        from .bert.extract_features import convert_lst_to_arrays, convert_lst_to_windows, get_bucket_length, \
+            pack_arrays
+
+        num_window = None
+        if msg and isinstance(msg[0], tuple):
+            # token ids from "encode_ids"
+            features, seq_len = self.convert_ids(msg, get_bucket_length)
+            get_tokens = lambda: [self.tokenizer.convert_ids_to_tokens(v[:n].tolist())
+                                  for v, n in zip(features['input_ids'], seq_len)]
+        else:
+            # check if msg is a list of list, if yes consider the input is already tokenized
+            is_tokenized = all(isinstance(el, list) for el in msg)
+            if self.sliding_window:
+                # a long sequence is split into windows, whose vectors are pooled back into one by the worker
+                features, tokens, num_window = convert_lst_to_windows(
+                    msg, self.max_seq_len, self.max_position_embeddings, self.tokenizer, self.logger, is_tokenized,
+                    self.mask_cls_sep, self.buffer, self.padding_buckets, self.window_stride)
+            else:
+                features, tokens = convert_lst_to_arrays(msg, self.max_seq_len, self.max_position_embeddings,
+                                                         self.tokenizer, self.logger, is_tokenized,
+                                                         self.mask_cls_sep, self.buffer, self.padding_buckets)
+            seq_len = [len(t) for t in tokens]
+            get_tokens = lambda: tokens
+        job_info = {}
+        if num_window is not None and len(num_window) < len(features['input_ids']):
+            job_info['num_window'] = num_window
+            job_info['window_len'] = np.count_nonzero(features['input_ids'], axis=1).tolist()
+        if self.ragged_output:
+            job_info['seq_len'] = seq_len
+        if self.show_tokens_to_client and self.compact_tokens:
+            # token ids are much smaller than the strings, the client maps them back by the vocab
+            ids = features['input_ids']
+            if 'num_window' in job_info:
+                # the rows are windows, the tokens of the whole sequences are sent
+                token_ids = np.array(self.tokenizer.convert_tokens_to_ids(list(chain.from_iterable(tokens))),
+                                     dtype=np.int32)
+            else:
+                token_ids = np.ascontiguousarray(ids[np.arange(ids.shape[1]) < np.array(seq_len)[:, None]])
+            for sink in BertWorker.get_sinks(sinks, client_id):
+                sink.send_multipart([client_id,
+                                     jsonapi.dumps({'dtype': str(token_ids.dtype), 'seq_len': seq_len}),
+                                     token_ids, ServerCmd.data_token_ids])
+        elif self.show_tokens_to_client:
+            for sink in BertWorker.get_sinks(sinks, client_id):
+                sink.send_multipart([client_id, jsonapi.dumps(get_tokens()), b'', ServerCmd.data_token])
+        if self.packed_buffer is not None:
+            features = pack_arrays(features, np.count_nonzero(features['input_mask'], axis=1), self.packed_buffer)
+        return features, job_info
+
+    def convert_ids(self, msg, get_bucket_length):
+        """pad the token ids of the sentences into features, there is no tokenization at all"""
+        vocab = self.tokenizer.vocab
+        seq_len = [min(len(v), self.max_seq_len or self.max_position_embeddings) for v, _ in msg]
+        max_len = self.max_seq_len or get_bucket_length(max(seq_len), self.padding_buckets)
+        features = dict(zip(self.feature_names, self.buffer.get(len(msg), max_len)))
+        for idx, ((ids, segment_ids), n) in enumerate(zip(msg, seq_len)):
+            # a long sentence is trimmed on the right side, keeping its last [SEP]
+            trim = (lambda v: np.concatenate([v[:(n - 1)], v[-1:]])) if len(ids) > n else (lambda v: v)
+            features['input_ids'][idx, :n] = trim(ids)
+            features['input_mask'][idx, :n] = 1
+            if segment_ids is not None:
+                features['input_type_ids'][idx, :n] = trim(segment_ids)
+        input_ids = features['input_ids']
+        # ids out of the vocabulary are taken as unknown tokens
+        input_ids[(input_ids < 0) | (input_ids >= len(vocab))] = vocab['[UNK]']
+        if self.mask_cls_sep:
+            features['input_mask'][(input_ids == vocab['[CLS]']) | (input_ids == vocab['[SEP]'])] = 0
+        return features, seq_len
 
 
 class BertWorker(Process):
-    def __init__(self, id, args, worker_address_list, sink_address, device_id, graph_path, graph_config):
+    def __init__(self, id, args, worker_address_list, sink_address_list, report_address, cancel_address, device_id,
+                 graph_path, graph_config):
         super().__init__()
         self.worker_id = id
         self.device_id = device_id
         self.logger = set_logger(colored('WORKER-%d' % self.worker_id, 'yellow'), args.verbose)
+        self.args = args
         self.max_seq_len = args.max_seq_len
-        self.do_lower_case = args.do_lower_case
-        self.mask_cls_sep = args.mask_cls_sep
+        self.num_tokenizer = args.num_tokenizer
         self.daemon = True
         self.exit_flag = multiprocessing.Event()
         self.worker_address = worker_address_list
         self.num_concurrent_socket = len(self.worker_address)
-        self.sink_address = sink_address
+        self.sink_address = sink_address_list
+        self.num_sink = len(self.sink_address)
+        self.report_address = report_address
+        self.cancel_address = cancel_address
         self.prefetch_size = args.prefetch_size if self.device_id > 0 else None  # set to zero for CPU-worker
         self.gpu_memory_fraction = args.gpu_memory_fraction
-        self.model_dir = args.model_dir
         self.verbose = args.verbose
         self.graph_path = graph_path
         self.bert_config = graph_config
+        self.padding_buckets = get_padding_buckets(args, graph_config)
+        self.window_pooling = args.window_pooling
         self.use_fp16 = args.fp16
-        self.show_tokens_to_client = args.show_tokens_to_client
+        self.session_engine = args.session_engine
+        self.shared_memory = args.shared_memory
+        self.port_out = args.port_out
         self.is_ready = multiprocessing.Event()
 
     def close(self):
@@ -492,6 +1852,12 @@ class BertWorker(Process):
                 'encodes': output[0]
             })
 
+        return Estimator(model_fn=model_fn, config=RunConfig(session_config=self.get_session_config(tf)))
+
+    def get_engine(self, tf):
+        return SessionEngine(tf, self.graph_path, self.get_session_config(tf))
+
+    def get_session_config(self, tf):
         config = tf.ConfigProto(device_count={'GPU': 0 if self.device_id < 0 else 1})
         config.gpu_options.allow_growth = True
         config.gpu_options.per_process_gpu_memory_fraction = self.gpu_memory_fraction
@@ -499,16 +1865,18 @@ class BertWorker(Process):
         # session-wise XLA doesn't seem to work on tf 1.10
         # if args.xla:
         #     config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
-
-        return Estimator(model_fn=model_fn, config=RunConfig(session_config=config))
+        return config
 
     def run(self):
         self._run()
 
     @zmqd.socket(zmq.PUSH)
     @zmqd.socket(zmq.PUSH)
+    @zmqd.socket(zmq.SUB)
     @multi_socket(zmq.PULL, num_socket='num_concurrent_socket')
-    def _run(self, sink_embed, sink_token, *receivers):
+    @multi_socket(zmq.PUSH, num_socket='num_sink')
+    @multi_socket(zmq.PUSH, num_socket='num_sink')
+    def _run(self, report, report_skip, canceller, *socks):
         # Windows does not support logger in MP environment, thus get a new logger
         # inside the process for better compatibility
         logger = set_logger(colored('WORKER-%d' % self.worker_id, 'yellow'), self.verbose)
@@ -517,56 +1885,201 @@ class BertWorker(Process):
                     ('cpu' if self.device_id < 0 else ('gpu: %d' % self.device_id), self.graph_path))
 
         tf = import_tf(self.device_id, self.verbose, use_fp16=self.use_fp16)
-        estimator = self.get_estimator(tf)
 
+        receivers, sink_embeds, sink_tokens = (socks[:self.num_concurrent_socket],
+                                               socks[self.num_concurrent_socket:-self.num_sink],
+                                               socks[-self.num_sink:])
         for sock, addr in zip(receivers, self.worker_address):
             sock.connect(addr)
 
-        sink_embed.connect(self.sink_address)
-        sink_token.connect(self.sink_address)
-        for r in estimator.predict(self.input_fn_builder(receivers, tf, sink_token), yield_single_examples=False):
-            send_ndarray(sink_embed, r['client_id'], r['encodes'], ServerCmd.data_embed)
+        # one socket to each sink for embeddings and tokens respectively
+        for sink_embed, sink_token, addr in zip(sink_embeds, sink_tokens, self.sink_address):
+            sink_embed.connect(addr)
+            sink_token.connect(addr)
+        report.connect(self.report_address)
+        report_skip.connect(self.report_address)
+        canceller.setsockopt(zmq.SUBSCRIBE, b'')
+        canceller.connect(self.cancel_address)
+        # info of the jobs being processed, e.g. the job size for shared memory, the sequence lengths for ragged output
+        job_infos = {}
+        if self.session_engine:
+            # the graph is loaded once into a session, which is fed with numpy arrays
+            results = self.get_engine(tf).predict(self.gen_builder(receivers, sink_tokens, report_skip, canceller,
+                                                                   job_infos)(), self.prefetch_size or 1)
+        else:
+            results = self.get_estimator(tf).predict(self.input_fn_builder(receivers, tf, sink_tokens, report_skip,
+                                                                           canceller, job_infos),
+                                                     yield_single_examples=False)
+        # the worker is ready once the graph is compiled for all shapes, i.e. all warm-up batches are done
+        num_warm_up = len(self.get_warm_up_shapes())
+        for r in results:
+            if not r['client_id']:
+                logger.info('warm-up done\tshape: %s' % (r['encodes'].shape,))
+                num_warm_up -= 1
+                if not num_warm_up:
+                    logger.info('ready and listening!')
+                    self.is_ready.set()
+                continue
+            job_info = job_infos[r['client_id']]
+            # the padding rows are always the last ones, also with sequence packing
+            num_pad_row = job_info['num_pad_row'].pop(0)
+            encodes = r['encodes'][:(len(r['encodes']) - num_pad_row)]
+            if job_info['num_pad_row']:
+                # a job over the token budget runs in several slices, wait for the rest of them
+                job_info.setdefault('encodes', []).append(encodes)
+                continue
+            job_infos.pop(r['client_id'])
+            r['encodes'] = np.concatenate(job_info.pop('encodes') + [encodes]) if 'encodes' in job_info else encodes
+            if 'num_window' in job_info:
+                r['encodes'] = self.pool_windows(r['encodes'], job_info['num_window'], job_info['window_len'])
+            sinks = self.get_sinks(sink_embeds, r['client_id'])
+            if 'seq_len' in job_info:
+                self.send_ragged_embed(sinks, r['client_id'], r['encodes'], job_info['seq_len'])
+            elif 'job_size' in job_info:
+                self.send_shm_embed(sinks, r['client_id'], r['encodes'], job_info['job_size'])
+            else:
+                for sink in sinks:
+                    send_ndarray(sink, r['client_id'], r['encodes'], ServerCmd.data_embed)
             logger.info('job done\tsize: %s\tclient: %s' % (r['encodes'].shape, r['client_id']))
+            # tell the ventilator that this worker is free for more sequences
+            report.send_multipart([b'%d' % self.worker_id, b'%d' % r['encodes'].shape[0],
+                                   b'%d' % job_info.get('num_token', 0), b'%d' % job_info.get('num_slot', 0)])
 
-    def input_fn_builder(self, socks, tf, sink):
-        from .bert.extract_features import convert_lst_to_features
-        from .bert.tokenization import FullTokenizer
+    def get_row_buckets(self, seq_len):
+        # the padded numbers of rows of a batch with this padding length, powers of two up to the most rows it has
+        max_row = self.args.max_batch_size
+        if self.args.max_tokens_per_batch:
+            max_row = min(max_row, max(self.args.max_tokens_per_batch // seq_len, 1))
+        return sorted({min(2 ** i, max_row) for i in range(max_row.bit_length() + 1)})
+
+    def get_warm_up_shapes(self):
+        # every (rows, length) shape that a batch is padded to with "padding_buckets"
+        return [(num_row, seq_len) for seq_len in self.padding_buckets for num_row in self.get_row_buckets(seq_len)]
+
+    @staticmethod
+    def get_dummy_features(num_row, seq_len):
+        # each row is a sequence of one [PAD] token, so that the pooling of any strategy is well defined
+        mask = np.zeros([num_row, seq_len], dtype=np.int32)
+        mask[:, 0] = 1
+        return {'input_ids': np.zeros_like(mask), 'input_mask': mask, 'input_type_ids': np.zeros_like(mask)}
+
+    def split_rows(self, features):
+        # slices of rows that have at most "max_tokens_per_batch" tokens each, including the padding
+        num_row, seq_len = features['input_ids'].shape
+        if self.padding_buckets:
+            # no more rows than the largest warmed-up row bucket, the windows of "sliding_window" can give
+            # more rows than "max_batch_size"
+            step = self.get_row_buckets(seq_len)[-1]
+        elif self.args.max_tokens_per_batch:
+            step = max(self.args.max_tokens_per_batch // seq_len, 1)
+        else:
+            step = num_row
+        if num_row <= step:
+            return [features]
+        return [{k: v[i:(i + step)] for k, v in features.items()} for i in range(0, num_row, step)]
+
+    def pad_rows(self, features):
+        """pad the rows of the features to the next row bucket, return them with the number of padding rows"""
+        from .bert.extract_features import get_bucket_length
+        num_row, seq_len = features['input_ids'].shape
+        num_pad_row = get_bucket_length(num_row, self.get_row_buckets(seq_len)) - num_row
+        if num_pad_row:
+            pad = self.get_dummy_features(num_pad_row, seq_len)
+            features = {k: np.concatenate([v, pad[k]]) for k, v in features.items()}
+        return features, num_pad_row
+
+    def pool_windows(self, x, num_window, window_len):
+        # the vectors of the windows of each sequence are pooled back into one vector
+        splits = np.cumsum(num_window)[:-1]
+        if self.window_pooling == 'MAX':
+            return np.stack([v.max(axis=0) for v in np.split(x, splits)])
+        weights = (np.split(np.array(window_len, dtype=np.float32), splits) if self.window_pooling == 'LENGTH_WEIGHTED'
+                   else [None] * len(num_window))
+        return np.stack([np.average(v, axis=0, weights=w) for v, w in zip(np.split(x, splits), weights)]).astype(x.dtype)
 
+    @staticmethod
+    def get_sinks(socks, job_id):
+        # a micro-batch may carry the jobs of several sinks, each of them gets the whole batch and picks its jobs
+        if len(socks) == 1:
+            return socks
+        return [socks[i] for i in sorted({BertSink.get_sink_id(k, len(socks)) for k, _, _ in MicroBatch.split(job_id)})]
+
+    def send_shm_embed(self, sinks, job_id, x, job_size):
+        # write the rows into the result buffer of the job, and only notify the sink
+        base_job_id, _, partial_id = job_id.partition(b'@')
+        offset = int(partial_id or 0)
+        buffer_shape = [job_size] + list(x.shape[1:])
+        if self.max_seq_len is None and x.ndim > 2:
+            # same as the sink, the buffer has the maximum length and is truncated at the end
+            buffer_shape[1] = self.bert_config.max_position_embeddings
+        buffer = open_shm_array(get_shm_path(self.port_out, base_job_id), x.dtype, buffer_shape)
+        buffer[offset:(offset + x.shape[0]), :x.shape[1]] = x
+        del buffer
+        for sink in sinks:
+            sink.send_multipart([job_id, jsonapi.dumps({'dtype': str(x.dtype), 'shape': x.shape,
+                                                        'buffer_shape': buffer_shape}),
+                                 b'', ServerCmd.data_embed_shm])
+
+    @staticmethod
+    def send_ragged_embed(sinks, job_id, x, seq_len):
+        # pack the valid tokens of all sentences into [num_tokens, dim], dropping the padding
+        x = x[np.arange(x.shape[1]) < np.array(seq_len)[:, None]]
+        for sink in sinks:
+            sink.send_multipart([job_id, jsonapi.dumps({'dtype': str(x.dtype), 'shape': x.shape, 'seq_len': seq_len}),
+                                 x, ServerCmd.data_embed])
+
+    def gen_builder(self, socks, sinks, report, canceller, job_infos):
         def gen():
             # Windows does not support logger in MP environment, thus get a new logger
             # inside the process for better compatibility
             logger = set_logger(colored('WORKER-%d' % self.worker_id, 'yellow'), self.verbose)
-            tokenizer = FullTokenizer(vocab_file=os.path.join(self.model_dir, 'vocab.txt'), do_lower_case=self.do_lower_case)
-
-            poller = zmq.Poller()
-            for sock in socks:
-                poller.register(sock, zmq.POLLIN)
-
-            logger.info('ready and listening!')
-            self.is_ready.set()
-
-            while not self.exit_flag.is_set():
-                events = dict(poller.poll())
-                for sock_idx, sock in enumerate(socks):
-                    if sock in events:
-                        client_id, raw_msg = sock.recv_multipart()
-                        msg = jsonapi.loads(raw_msg)
-                        logger.info('new job\tsocket: %d\tsize: %d\tclient: %s' % (sock_idx, len(msg), client_id))
-                        # check if msg is a list of list, if yes consider the input is already tokenized
-                        is_tokenized = all(isinstance(el, list) for el in msg)
-                        tmp_f = list(convert_lst_to_features(msg, self.max_seq_len,
-                                                             self.bert_config.max_position_embeddings,
-                                                             tokenizer, logger,
-                                                             is_tokenized, self.mask_cls_sep))
-                        if self.show_tokens_to_client:
-                            sink.send_multipart([client_id, jsonapi.dumps([f.tokens for f in tmp_f]),
-                                                 b'', ServerCmd.data_token])
-                        yield {
-                            'client_id': client_id,
-                            'input_ids': [f.input_ids for f in tmp_f],
-                            'input_mask': [f.input_mask for f in tmp_f],
-                            'input_type_ids': [f.input_type_ids for f in tmp_f]
-                        }
+            # with a tokenizer stage, workers receive the features ready to run
+            converter = JobConverter(self.args, self.bert_config, logger) if not self.num_tokenizer else None
+
+            warm_up_shapes = self.get_warm_up_shapes()
+            for num_row, seq_len in warm_up_shapes:
+                # run a batch of every padded shape first, so that the graph is compiled for all of them
+                # before serving. The results have an empty client id, the worker is ready once all are done
+                yield {'client_id': b'', **self.get_dummy_features(num_row, seq_len)}
+            if not warm_up_shapes:
+                logger.info('ready and listening!')
+                self.is_ready.set()
+
+            for sock_idx, client_id, job_info, msg, msg_len in JobConverter.receive_jobs(
+                    socks, canceller, report, self.worker_id, self.exit_flag, logger, bool(self.num_tokenizer)):
+                logger.info('new job\tsocket: %d\tsize: %d\tclient: %s' % (sock_idx, msg_len, client_id))
+                if converter is not None:
+                    features, convert_info = converter.convert(client_id, msg, sinks)
+                    job_info.update(convert_info)
+                else:
+                    features = msg
+                # the exact padded size is known now, a job over the token budget runs in slices of rows
+                slices, num_pad_row = self.split_rows(features), []
+                for idx, v in enumerate(slices):
+                    if self.padding_buckets:
+                        # the number of rows is padded too, so that the model only sees the warmed-up shapes
+                        slices[idx], n = self.pad_rows(v)
+                        num_pad_row.append(n)
+                    else:
+                        num_pad_row.append(0)
+                # the non-padding tokens ([PAD] is 0) and all tokens of the batch, for the token utilization
+                job_infos[client_id] = {'num_token': int(np.count_nonzero(features['input_ids'])),
+                                        'num_slot': sum(v['input_ids'].size for v in slices),
+                                        'num_pad_row': num_pad_row}
+                if job_info.get('seq_len'):
+                    job_infos[client_id]['seq_len'] = job_info['seq_len']
+                elif job_info.get('job_size') and b'|' not in client_id:
+                    job_infos[client_id]['job_size'] = job_info['job_size']
+                if job_info.get('num_window'):
+                    job_infos[client_id].update(num_window=job_info['num_window'],
+                                                window_len=job_info['window_len'])
+                for v in slices:
+                    yield {'client_id': client_id, **v}
+
+        return gen
+
+    def input_fn_builder(self, socks, tf, sinks, report, canceller, job_infos):
+        gen = self.gen_builder(socks, sinks, report, canceller, job_infos)
 
         def input_fn():
             return (tf.data.Dataset.from_generator(
@@ -595,9 +2108,24 @@ class ServerStatistic:
         self._last_req_time = time.perf_counter()
         self._last_two_req_interval = []
         self._num_last_two_req = 200
+        self._num_micro_batch = 0
+        self._num_micro_batch_timeout = 0
+        self._micro_batch_fill = []
+        self._micro_batch_num_job = []
+        self._num_bucketed_req = 0
+        self._padded_before_bucketing = 0
+        self._padded_after_bucketing = 0
+        self._padding_saved = []
+        self._num_cache_hit = 0
+        self._num_cache_miss = 0
+        self._num_cache_eviction = 0
+        self._num_rejected_req = 0
+        self._num_token = 0
+        self._num_token_slot = 0
+        self._token_utilization = []
 
     def update(self, request):
-        client, msg, req_id, msg_len = request
+        client, msg, req_id, msg_len, *_ = request
         self._hist_client[client] += 1
         if ServerCmd.is_valid(msg):
             self._num_sys_req += 1
@@ -614,6 +2142,38 @@ class ServerStatistic:
                 self._last_two_req_interval.pop(0)
             self._last_req_time = tmp
 
+    def update_micro_batch(self, fill_ratio, num_job, is_timeout):
+        self._num_micro_batch += 1
+        self._num_micro_batch_timeout += int(is_timeout)
+        if len(self._micro_batch_fill) >= self._num_last_two_req:
+            self._micro_batch_fill.pop(0)
+            self._micro_batch_num_job.pop(0)
+        self._micro_batch_fill.append(fill_ratio)
+        self._micro_batch_num_job.append(num_job)
+
+    def update_length_bucketing(self, padded_before, padded_after):
+        self._num_bucketed_req += 1
+        self._padded_before_bucketing += padded_before
+        self._padded_after_bucketing += padded_after
+        if len(self._padding_saved) >= self._num_last_two_req:
+            self._padding_saved.pop(0)
+        self._padding_saved.append(1 - padded_after / padded_before)
+
+    def update_cache(self, num_hit=0, num_miss=0, num_evicted=0):
+        self._num_cache_hit += num_hit
+        self._num_cache_miss += num_miss
+        self._num_cache_eviction += num_evicted
+
+    def update_token_usage(self, num_token, num_slot):
+        self._num_token += num_token
+        self._num_token_slot += num_slot
+        if len(self._token_utilization) >= self._num_last_two_req:
+            self._token_utilization.pop(0)
+        self._token_utilization.append(num_token / num_slot if num_slot else 0)
+
+    def update_rejected(self):
+        self._num_rejected_req += 1
+
     @property
     def value(self):
         def get_min_max_avg(name, stat):
@@ -639,11 +2199,25 @@ class ServerStatistic:
             'num_sys_request': self._num_sys_req,
             'num_total_request': self._num_data_req + self._num_sys_req,
             'num_total_client': len(self._hist_client),
-            'num_active_client': get_num_active_client()},
+            'num_active_client': get_num_active_client(),
+            'num_micro_batch': self._num_micro_batch,
+            'num_micro_batch_timeout': self._num_micro_batch_timeout,
+            'num_bucketed_request': self._num_bucketed_req,
+            'total_padding_saved': (1 - self._padded_after_bucketing / self._padded_before_bucketing
+                                    if self._padded_before_bucketing else 0),
+            'num_cache_hit': self._num_cache_hit,
+            'num_cache_miss': self._num_cache_miss,
+            'num_cache_eviction': self._num_cache_eviction,
+            'num_rejected_request': self._num_rejected_req,
+            'total_token_utilization': self._num_token / self._num_token_slot if self._num_token_slot else 0},
             get_min_max_avg('request_per_client', self._hist_client.values()),
             get_min_max_avg('size_per_request', self._hist_msg_len.keys()),
             get_min_max_avg('last_two_interval', self._last_two_req_interval),
             get_min_max_avg('request_per_second', [1. / v for v in self._last_two_req_interval]),
+            get_min_max_avg('micro_batch_fill', self._micro_batch_fill),
+            get_min_max_avg('job_per_micro_batch', self._micro_batch_num_job),
+            get_min_max_avg('padding_saved', self._padding_saved),
+            get_min_max_avg('token_utilization', self._token_utilization),
         ]
 
         return {k: v for d in parts for k, v in d.items()}
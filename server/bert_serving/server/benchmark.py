@@ -13,6 +13,7 @@ class BenchmarkClient(threading.Thread):
         self.avg_time = 0
         self.port = cargs.port
         self.port_out = cargs.port_out
+        self.router_result = cargs.router_result
 
     def run(self):
         try:
@@ -20,7 +21,7 @@ class BenchmarkClient(threading.Thread):
         except ImportError:
             raise ImportError('BertClient module is not available, it is required for benchmarking.'
                               'Please use "pip install -U bert-serving-client" to install it.')
-        with BertClient(port=self.port, port_out=self.port_out,
+        with BertClient(port=self.port, port_out=self.port_out, router_result=self.router_result,
                         show_server_config=True, check_version=False, check_length=False) as bc:
             time_all = []
             for _ in range(self.num_repeat):
@@ -79,3 +80,233 @@ def run_benchmark(args):
                 print('|%s\t|%d|' % (cvar, cavg_speed), file=fw)
             # for additional plotting
             print('\n%s = %s\n%s = %s' % (exp_name, exp_vars, 'speed', avg_speed), file=fw)
+
+
+def run_sink_benchmark(args):
+    """drive many concurrent pending jobs through BertSink without running a model"""
+    from argparse import Namespace
+    import numpy as np
+    import zmq
+    from bert_serving.server import BertSink, BertResultProxy, ServerCmd
+    from bert_serving.server.helper import auto_bind, get_args_parser, send_ndarray
+
+    partial = np.random.random([args.partial_size, args.embed_dim]).astype(np.float32)
+    avg_cost = {}
+
+    for num_sink in args.num_sink:
+        # the default server config, no model is loaded by the sink
+        sink_args = get_args_parser().parse_args(['-model_dir', '', '-port_out', str(args.port_out),
+                                                  '-num_sink', str(num_sink)])
+        for num_job in args.num_pending_job:
+            with zmq.Context() as ctx:
+                receiver = ctx.socket(zmq.SUB)
+                receiver.setsockopt(zmq.RCVHWM, 0)
+                receiver.setsockopt(zmq.SUBSCRIBE, b'')
+                receiver.connect('tcp://localhost:%d' % args.port_out)
+
+                frontends, sinks, addr_sink, addr_sink_result = [], [], [], []
+                for idx in range(num_sink):
+                    frontend = ctx.socket(zmq.PAIR)
+                    sink = BertSink(sink_args, auto_bind(frontend), Namespace(max_position_embeddings=512), idx)
+                    sink.start()
+                    addr_sink.append(frontend.recv().decode('ascii'))
+                    addr_sink_result.append(frontend.recv().decode('ascii'))
+                    frontends.append(frontend)
+                    sinks.append(sink)
+                if num_sink > 1:
+                    sinks.append(BertResultProxy(sink_args, addr_sink_result))
+                    sinks[-1].start()
+                for sink in sinks:
+                    sink.is_ready.wait()
+                time.sleep(0.5)  # let the result receiver connect
+
+                # register all jobs first, so that all of them are pending when the partial results arrive
+                job_size = args.partial_size * args.num_partial
+                for j in range(num_job):
+                    frontends[BertSink.get_sink_id(b'bench#%d' % j, num_sink)].send_multipart(
+                        [b'bench', ServerCmd.new_job, b'%d' % job_size, b'%d' % j, b'{}'])
+
+                def send_partials():
+                    workers = [ctx.socket(zmq.PUSH) for _ in addr_sink]
+                    for w, addr in zip(workers, addr_sink):
+                        w.connect(addr)
+                    # partials are interleaved across jobs, every job stays pending until its last partial
+                    for p in range(args.num_partial):
+                        for j in range(num_job):
+                            send_ndarray(workers[BertSink.get_sink_id(b'bench#%d' % j, num_sink)],
+                                         b'bench#%d@%d' % (j, p * args.partial_size), partial, ServerCmd.data_embed)
+                    for w in workers:
+                        w.close()
+
+                start_t = time.perf_counter()
+                t = threading.Thread(target=send_partials)
+                t.start()
+
+                poller = zmq.Poller()
+                for frontend in frontends:
+                    poller.register(frontend, zmq.POLLIN)
+                poller.register(receiver, zmq.POLLIN)
+                num_done = 0
+                while num_done < num_job:
+                    socks = dict(poller.poll())
+                    for frontend in frontends:
+                        if socks.get(frontend) == zmq.POLLIN:
+                            # job-done notifications to the ventilator
+                            frontend.recv_multipart()
+                    if socks.get(receiver) == zmq.POLLIN:
+                        receiver.recv_multipart()
+                        num_done += 1
+                cost = (time.perf_counter() - start_t) / (num_job * args.num_partial) * 1e6
+                t.join()
+                for sink in sinks:
+                    sink.close()
+                for frontend in frontends:
+                    frontend.close()
+                receiver.close()
+
+            print('sinks: %d\tpending jobs: %d\tcost per message: %.1f us' % (num_sink, num_job, cost), flush=True)
+            avg_cost[(num_sink, num_job)] = cost
+
+    with open('benchmark-sink.result', 'a') as fw:
+        print('\n|`num_pending_job`\t|%s|\n|---|%s' % ('|'.join('%d sink(s) us/message' % n for n in args.num_sink),
+                                                       '---|' * len(args.num_sink)), file=fw)
+        for num_job in args.num_pending_job:
+            print('|%d\t|%s|' % (num_job, '|'.join('%.1f' % avg_cost[(n, num_job)] for n in args.num_sink)), file=fw)
+        print('\n%s = %s\n%s = %s\n%s = %s' % ('num_sink', args.num_sink, 'num_pending_job', args.num_pending_job,
+                                                'cost', [avg_cost[(n, j)] for n in args.num_sink
+                                                         for j in args.num_pending_job]), file=fw)
+
+
+def run_feature_benchmark(args):
+    """compare the columnar feature construction against the list-based InputFeatures"""
+    import os
+    import numpy as np
+    from bert_serving.server.bert.extract_features import convert_lst_to_features, convert_lst_to_arrays, FeatureBuffer
+    from bert_serving.server.bert.tokenization import FullTokenizer
+    from bert_serving.server.helper import set_logger
+
+    logger = set_logger('BENCHMARK')
+    tokenizer = FullTokenizer(vocab_file=os.path.join(args.model_dir, 'vocab.txt'))
+    with open(args.client_vocab_file, encoding='utf8') as fp:
+        vocab = list(set(vv for v in fp for vv in v.strip().split()))
+
+    def features_by_list(batch, max_seq_len):
+        tmp_f = list(convert_lst_to_features(batch, max_seq_len, max_seq_len, tokenizer, logger,
+                                             is_tokenized=True, mask_cls_sep=args.mask_cls_sep))
+        return {k: np.array([getattr(f, k) for f in tmp_f], dtype=np.int32)
+                for k in ['input_ids', 'input_mask', 'input_type_ids']}
+
+    buffer = FeatureBuffer()
+
+    def features_by_array(batch, max_seq_len):
+        return convert_lst_to_arrays(batch, max_seq_len, max_seq_len, tokenizer, logger,
+                                     is_tokenized=True, mask_cls_sep=args.mask_cls_sep, buffer=buffer)[0]
+
+    avg_cost = {}
+    for max_seq_len in args.max_seq_len:
+        for batch_size in args.batch_size:
+            # the sentences are tokenized in advance, so that only the feature construction is measured
+            batch = [tokenizer.tokenize(' '.join(random.choices(vocab, k=max_seq_len)))[:max_seq_len]
+                     for _ in range(batch_size)]
+            # both implementations must give the same features
+            x, y = features_by_list(batch, max_seq_len), features_by_array(batch, max_seq_len)
+            assert all(np.array_equal(x[k], y[k]) for k in x)
+            for name, fn in [('list', features_by_list), ('array', features_by_array)]:
+                time_all = []
+                for _ in range(args.num_repeat):
+                    start_t = time.perf_counter()
+                    fn(batch, max_seq_len)
+                    time_all.append(time.perf_counter() - start_t)
+                avg_cost[(name, max_seq_len, batch_size)] = mean(time_all[2:]) * 1e3
+            print('max_seq_len: %d\tbatch size: %d\tlist: %.2f ms\tarray: %.2f ms' % (
+                max_seq_len, batch_size, avg_cost[('list', max_seq_len, batch_size)],
+                avg_cost[('array', max_seq_len, batch_size)]), flush=True)
+
+    with open('benchmark-features.result', 'a') as fw:
+        for max_seq_len in args.max_seq_len:
+            print('\n|`batch_size` (max_seq_len=%d)\t|list ms/batch|array ms/batch|\n|---|---|---|' % max_seq_len,
+                  file=fw)
+            for batch_size in args.batch_size:
+                print('|%d\t|%.2f|%.2f|' % (batch_size, avg_cost[('list', max_seq_len, batch_size)],
+                                             avg_cost[('array', max_seq_len, batch_size)]), file=fw)
+
+
+def run_packing_benchmark(args):
+    """compare the encodes of packed and unpacked batches on a small random model, and their speed"""
+    from copy import deepcopy
+    import numpy as np
+    from bert_serving.server.bert.extract_features import pack_arrays
+    from bert_serving.server.bert.modeling import BertConfig
+    from bert_serving.server.graph import build_encodes
+    from bert_serving.server.helper import import_tf
+
+    tf = import_tf(verbose=args.verbose)
+    bert_config = BertConfig(vocab_size=args.vocab_size, hidden_size=args.hidden_size,
+                             num_hidden_layers=args.num_hidden_layers, num_attention_heads=args.num_attention_heads,
+                             intermediate_size=4 * args.hidden_size, max_position_embeddings=max(args.max_seq_len))
+    rng = np.random.RandomState(args.seed)
+
+    def build(graph_args, weights=None):
+        # a graph of its own, the packed graph takes the random weights of the unpacked one
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.set_random_seed(args.seed)
+            inputs = [tf.placeholder(tf.int32, (None, None), k) for k in ['input_ids', 'input_mask', 'input_type_ids']]
+            encodes = build_encodes(tf, graph_args, bert_config, *inputs)
+            tvars = tf.trainable_variables()
+            sess = tf.Session(graph=graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+            if weights is None:
+                sess.run(tf.global_variables_initializer())
+                weights = dict(zip([v.name for v in tvars], sess.run(tvars)))
+            else:
+                for v in tvars:
+                    v.load(weights[v.name], sess)
+        return lambda f: sess.run(encodes, feed_dict={v: f[v.op.name] for v in inputs}), weights
+
+    avg_cost = {}
+    for pooling_strategy in args.pooling_strategy:
+        graph_args = deepcopy(args)
+        graph_args.pooling_strategy, graph_args.fp16 = pooling_strategy, False
+        graph_args.sequence_packing = False
+        run_unpacked, weights = build(graph_args)
+        graph_args.sequence_packing = True
+        run_packed, _ = build(graph_args, weights)
+
+        for max_seq_len in args.max_seq_len:
+            for batch_size in args.batch_size:
+                # random sentences of 1 to "max_seq_len" tokens, the second half of each one is segment 1
+                seq_len = rng.randint(1, max_seq_len + 1, batch_size)
+                features = {k: np.zeros([batch_size, max_seq_len], dtype=np.int32)
+                            for k in ['input_ids', 'input_mask', 'input_type_ids']}
+                for idx, n in enumerate(seq_len):
+                    features['input_ids'][idx, :n] = rng.randint(1, args.vocab_size, n)
+                    features['input_mask'][idx, :n] = 1
+                    features['input_type_ids'][idx, (n // 2):n] = 1
+                packed = pack_arrays(features, seq_len)
+                # the packed batch must give the same encodes as the unpacked one
+                x, y = run_unpacked(features), run_packed(packed)
+                max_diff = float(np.max(np.abs(x - y)))
+                assert x.shape == y.shape and max_diff < args.tolerance, \
+                    'packed encodes differ by %g with pooling_strategy=%s' % (max_diff, pooling_strategy)
+                for name, fn, f in [('unpacked', run_unpacked, features), ('packed', run_packed, packed)]:
+                    time_all = []
+                    for _ in range(args.num_repeat):
+                        start_t = time.perf_counter()
+                        fn(f)
+                        time_all.append(time.perf_counter() - start_t)
+                    avg_cost[(name, pooling_strategy, max_seq_len, batch_size)] = mean(time_all[2:]) * 1e3
+                print('pooling_strategy: %s\tmax_seq_len: %d\tbatch size: %d\trows: %d\tmax abs diff: %g\t'
+                      'unpacked: %.2f ms\tpacked: %.2f ms' % (
+                          pooling_strategy, max_seq_len, batch_size, len(packed['input_ids']), max_diff,
+                          avg_cost[('unpacked', pooling_strategy, max_seq_len, batch_size)],
+                          avg_cost[('packed', pooling_strategy, max_seq_len, batch_size)]), flush=True)
+
+    with open('benchmark-packing.result', 'a') as fw:
+        for pooling_strategy in args.pooling_strategy:
+            for max_seq_len in args.max_seq_len:
+                print('\n|`batch_size` (%s, max_seq_len=%d)\t|unpacked ms/batch|packed ms/batch|\n|---|---|---|' % (
+                    pooling_strategy, max_seq_len), file=fw)
+                for batch_size in args.batch_size:
+                    print('|%d\t|%.2f|%.2f|' % (
+                        batch_size, avg_cost[('unpacked', pooling_strategy, max_seq_len, batch_size)],
+                        avg_cost[('packed', pooling_strategy, max_seq_len, batch_size)]), file=fw)
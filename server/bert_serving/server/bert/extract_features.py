@@ -14,9 +14,12 @@
 # limitations under the License.
 import re
 
+import numpy as np
+
 from . import tokenization
 
-__all__ = ['convert_lst_to_features']
+__all__ = ['convert_lst_to_features', 'convert_lst_to_arrays', 'convert_lst_to_windows', 'get_bucket_length',
+           'pack_arrays', 'FeatureBuffer']
 
 
 class InputExample(object):
@@ -38,29 +41,34 @@ class InputFeatures(object):
         self.input_type_ids = input_type_ids
 
 
-def convert_lst_to_features(lst_str, max_seq_length, max_position_embeddings,
-                            tokenizer, logger, is_tokenized=False, mask_cls_sep=False):
-    """Loads a data file into a list of `InputBatch`s."""
+class FeatureBuffer(object):
+    """Preallocated int32 arrays for the features, reused by the following batches.
 
-    examples = read_tokenized_examples(lst_str) if is_tokenized else read_examples(lst_str)
+    The buffers are used in turn, so the features of a batch are only overwritten after
+    "num_slot" more batches, e.g. when they are not in a prefetch queue anymore.
+    """
 
-    _tokenize = lambda x: tokenizer.mark_unk_tokens(x) if is_tokenized else tokenizer.tokenize(x)
+    def __init__(self, num_slot=1):
+        self.slots = [np.zeros(0, dtype=np.int32) for _ in range(num_slot)]
+        self.next_slot = 0
 
-    all_tokens = [(_tokenize(ex.text_a), _tokenize(ex.text_b) if ex.text_b else []) for ex in examples]
+    def get(self, batch_size, seq_len):
+        """return zeroed "input_ids", "input_mask" and "input_type_ids" of shape [batch_size, seq_len]"""
+        size = 3 * batch_size * seq_len
+        if self.slots[self.next_slot].size < size:
+            self.slots[self.next_slot] = np.zeros(size, dtype=np.int32)
+        arrays = self.slots[self.next_slot][:size].reshape([3, batch_size, seq_len])
+        self.next_slot = (self.next_slot + 1) % len(self.slots)
+        arrays.fill(0)
+        return arrays
 
-    # user did not specify a meaningful sequence length
-    # override the sequence length by the maximum seq length of the current batch
-    if max_seq_length is None:
-        max_seq_length = max(len(ta) + len(tb) for ta, tb in all_tokens)
-        # add special tokens into account
-        # case 1: Account for [CLS], tokens_a [SEP], tokens_b [SEP] -> 3 additional tokens
-        # case 2: Account for [CLS], tokens_a [SEP] -> 2 additional tokens
-        max_seq_length += 3 if any(len(tb) for _, tb in all_tokens) else 2
-        max_seq_length = min(max_seq_length, max_position_embeddings)
-        logger.warning('"max_seq_length" is undefined, '
-                       'and bert config json defines "max_position_embeddings"=%d. '
-                       'hence set "max_seq_length"=%d according to the current batch.' % (
-                           max_position_embeddings, max_seq_length))
+
+def convert_lst_to_features(lst_str, max_seq_length, max_position_embeddings,
+                            tokenizer, logger, is_tokenized=False, mask_cls_sep=False):
+    """Loads a data file into a list of `InputBatch`s."""
+
+    all_tokens, max_seq_length = _tokenize_lst(lst_str, max_seq_length, max_position_embeddings,
+                                               tokenizer, logger, is_tokenized)
 
     for (tokens_a, tokens_b) in all_tokens:
         if tokens_b:
@@ -125,6 +133,150 @@ def convert_lst_to_features(lst_str, max_seq_length, max_position_embeddings,
             input_type_ids=input_type_ids)
 
 
+def convert_lst_to_arrays(lst_str, max_seq_length, max_position_embeddings,
+                          tokenizer, logger, is_tokenized=False, mask_cls_sep=False, buffer=None,
+                          padding_buckets=None):
+    """Same as `convert_lst_to_features`, but writes the features into [batch_size, max_seq_length] int32 arrays.
+
+    Returns a dict of "input_ids", "input_mask" and "input_type_ids", and the tokens of each sequence.
+    The arrays are taken from `buffer` if given, they are only valid until the buffer is reused.
+    If `max_seq_length` is None, the arrays are padded to the smallest of `padding_buckets` that fits the batch.
+    """
+
+    dynamic_length = max_seq_length is None
+    all_tokens, max_seq_length = _tokenize_lst(lst_str, max_seq_length, max_position_embeddings,
+                                               tokenizer, logger, is_tokenized)
+    if dynamic_length and padding_buckets:
+        max_seq_length = get_bucket_length(max_seq_length, padding_buckets)
+    features, lst_tokens = _fill_arrays(all_tokens, max_seq_length, tokenizer, mask_cls_sep, buffer)
+    logger.debug('converted %d sequences into arrays of length %d' % (len(all_tokens), max_seq_length))
+    return features, lst_tokens
+
+
+def convert_lst_to_windows(lst_str, max_seq_length, max_position_embeddings,
+                           tokenizer, logger, is_tokenized=False, mask_cls_sep=False, buffer=None,
+                           padding_buckets=None, window_stride=0):
+    """Same as `convert_lst_to_arrays`, but a single sequence that is too long is split into overlapping windows.
+
+    Each window has at most `max_seq_length` tokens including [CLS] and [SEP], and starts `window_stride` tokens
+    after the previous one (half a window if 0). The last window ends at the end of the sequence.
+    Returns the features of all windows, the tokens of each sequence, and the number of windows of each sequence.
+    Sequence pairs are never split, they are truncated as usual.
+    """
+
+    dynamic_length = max_seq_length is None
+    all_tokens, max_seq_length = _tokenize_lst(lst_str, max_seq_length, max_position_embeddings,
+                                               tokenizer, logger, is_tokenized)
+    if dynamic_length and padding_buckets:
+        max_seq_length = get_bucket_length(max_seq_length, padding_buckets)
+    size = max_seq_length - 2
+    stride = min(window_stride or max(size // 2, 1), size)
+    all_windows, lst_tokens, num_window = [], [], []
+    for tokens_a, tokens_b in all_tokens:
+        if tokens_b or len(tokens_a) <= size:
+            all_windows.append((tokens_a, tokens_b))
+            num_window.append(1)
+        else:
+            starts = list(range(0, len(tokens_a) - size, stride)) + [len(tokens_a) - size]
+            all_windows.extend((tokens_a[i:(i + size)], []) for i in starts)
+            lst_tokens.append(['[CLS]'] + tokens_a + ['[SEP]'])
+            num_window.append(len(starts))
+    features, window_tokens = _fill_arrays(all_windows, max_seq_length, tokenizer, mask_cls_sep, buffer)
+    # the tokens of the sequences that are not split are those of their only window
+    offsets, lst_tokens = np.cumsum([0] + num_window[:-1]), iter(lst_tokens)
+    lst_tokens = [window_tokens[i] if n == 1 else next(lst_tokens) for i, n in zip(offsets, num_window)]
+    logger.debug('converted %d sequences into %d windows of length %d' % (
+        len(all_tokens), len(all_windows), max_seq_length))
+    return features, lst_tokens, num_window
+
+
+def _fill_arrays(all_tokens, max_seq_length, tokenizer, mask_cls_sep, buffer):
+    """Writes the tokens of each sequence pair into the features, returns them and the tokens of each row."""
+
+    input_ids, input_mask, input_type_ids = (buffer or FeatureBuffer()).get(len(all_tokens), max_seq_length)
+    len_a, seq_len = np.zeros([2, len(all_tokens)], dtype=np.int64)
+    lst_tokens = []
+
+    for idx, (tokens_a, tokens_b) in enumerate(all_tokens):
+        # same truncation and layout as `convert_lst_to_features`
+        if tokens_b:
+            _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
+        elif len(tokens_a) > max_seq_length - 2:
+            tokens_a = tokens_a[0:(max_seq_length - 2)]
+        tokens = ['[CLS]'] + tokens_a + ['[SEP]'] + (tokens_b + ['[SEP]'] if tokens_b else [])
+        len_a[idx], seq_len[idx] = len(tokens_a), len(tokens)
+        input_ids[idx, :len(tokens)] = tokenizer.convert_tokens_to_ids(tokens)
+        input_type_ids[idx, (len(tokens_a) + 2):len(tokens)] = 1
+        lst_tokens.append(tokens)
+
+    input_mask[np.arange(max_seq_length) < seq_len[:, None]] = 1
+    if mask_cls_sep:
+        rows, has_b = np.arange(len(all_tokens)), seq_len > len_a + 2
+        input_mask[:, 0] = 0
+        input_mask[rows, len_a + 1] = 0
+        input_mask[rows[has_b], seq_len[has_b] - 1] = 0
+
+    return {'input_ids': input_ids, 'input_mask': input_mask, 'input_type_ids': input_type_ids}, lst_tokens
+
+
+def pack_arrays(features, seq_len, buffer=None):
+    """Packs the sequences of the features into as few rows of the same length as possible.
+
+    The sequences keep their order, each row takes the following sequences as long as they fit. In the
+    packed "input_mask", the tokens of the k-th sequence of a row are marked by k (starting from 1).
+    """
+
+    max_seq_length = features['input_ids'].shape[1]
+    # row, offset and index in the row of each sequence, an empty sequence still takes one token
+    seq_len = [max(n, 1) for n in seq_len]
+    rows, offsets, indices = [], [], []
+    row, offset, index = -1, max_seq_length, 0
+    for n in seq_len:
+        if offset + n > max_seq_length:
+            row, offset, index = row + 1, 0, 0
+        rows.append(row)
+        offsets.append(offset)
+        indices.append(index + 1)
+        offset, index = offset + n, index + 1
+    input_ids, input_mask, input_type_ids = (buffer or FeatureBuffer()).get(rows[-1] + 1, max_seq_length)
+    for idx, (row, offset, n) in enumerate(zip(rows, offsets, seq_len)):
+        input_ids[row, offset:(offset + n)] = features['input_ids'][idx, :n]
+        input_type_ids[row, offset:(offset + n)] = features['input_type_ids'][idx, :n]
+        input_mask[row, offset:(offset + n)] = indices[idx]
+    return {'input_ids': input_ids, 'input_mask': input_mask, 'input_type_ids': input_type_ids}
+
+
+def get_bucket_length(seq_length, padding_buckets):
+    """Returns the smallest of the ascending `padding_buckets` that fits `seq_length`, or `seq_length` itself."""
+    return next((b for b in padding_buckets if b >= seq_length), seq_length)
+
+
+def _tokenize_lst(lst_str, max_seq_length, max_position_embeddings, tokenizer, logger, is_tokenized):
+    """Tokenizes the sequences, returns the tokens of each sequence pair and the final max_seq_length."""
+
+    examples = read_tokenized_examples(lst_str) if is_tokenized else read_examples(lst_str)
+
+    _tokenize = lambda x: tokenizer.mark_unk_tokens(x) if is_tokenized else tokenizer.tokenize(x)
+
+    all_tokens = [(_tokenize(ex.text_a), _tokenize(ex.text_b) if ex.text_b else []) for ex in examples]
+
+    # user did not specify a meaningful sequence length
+    # override the sequence length by the maximum seq length of the current batch
+    if max_seq_length is None:
+        max_seq_length = max(len(ta) + len(tb) for ta, tb in all_tokens)
+        # add special tokens into account
+        # case 1: Account for [CLS], tokens_a [SEP], tokens_b [SEP] -> 3 additional tokens
+        # case 2: Account for [CLS], tokens_a [SEP] -> 2 additional tokens
+        max_seq_length += 3 if any(len(tb) for _, tb in all_tokens) else 2
+        max_seq_length = min(max_seq_length, max_position_embeddings)
+        logger.warning('"max_seq_length" is undefined, '
+                       'and bert config json defines "max_position_embeddings"=%d. '
+                       'hence set "max_seq_length"=%d according to the current batch.' % (
+                           max_position_embeddings, max_seq_length))
+
+    return all_tokens, max_seq_length
+
+
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
     """Truncates a sequence pair in place to the maximum length."""
 
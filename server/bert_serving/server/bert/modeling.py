@@ -133,7 +133,9 @@ class BertModel(object):
                  input_mask=None,
                  token_type_ids=None,
                  use_one_hot_embeddings=True,
-                 scope=None):
+                 scope=None,
+                 attention_mask=None,
+                 position_ids=None):
         """Constructor for BertModel.
 
         Args:
@@ -148,6 +150,10 @@ class BertModel(object):
             it is must faster if this is True, on the CPU or GPU, it is faster if
             this is False.
           scope: (optional) variable scope. Defaults to "bert".
+          attention_mask: (optional) float32 Tensor of shape [batch_size, seq_length,
+            seq_length]. Overrides the attention mask created from `input_mask`.
+          position_ids: (optional) int32 Tensor of shape [batch_size, seq_length].
+            Defaults to [0, 1, ..., seq_length-1] for every sequence.
 
         Raises:
           ValueError: The config is invalid or one of the input tensor shapes
@@ -191,14 +197,16 @@ class BertModel(object):
                     position_embedding_name="position_embeddings",
                     initializer_range=config.initializer_range,
                     max_position_embeddings=config.max_position_embeddings,
-                    dropout_prob=config.hidden_dropout_prob)
+                    dropout_prob=config.hidden_dropout_prob,
+                    position_ids=position_ids)
 
             with tf.variable_scope("encoder"):
                 # This converts a 2D mask of shape [batch_size, seq_length] to a 3D
                 # mask of shape [batch_size, seq_length, seq_length] which is used
                 # for the attention scores.
-                attention_mask = create_attention_mask_from_input_mask(
-                    input_ids, input_mask)
+                if attention_mask is None:
+                    attention_mask = create_attention_mask_from_input_mask(
+                        input_ids, input_mask)
 
                 # Run the stacked transformer.
                 # `sequence_output` shape = [batch_size, seq_length, hidden_size].
@@ -436,7 +444,8 @@ def embedding_postprocessor(input_tensor,
                             position_embedding_name="position_embeddings",
                             initializer_range=0.02,
                             max_position_embeddings=512,
-                            dropout_prob=0.1):
+                            dropout_prob=0.1,
+                            position_ids=None):
     """Performs various post-processing on a word embedding tensor.
 
     Args:
@@ -457,6 +466,8 @@ def embedding_postprocessor(input_tensor,
         used with this model. This can be longer than the sequence length of
         input_tensor, but cannot be shorter.
       dropout_prob: float. Dropout probability applied to the final output tensor.
+      position_ids: (optional) int32 Tensor of shape [batch_size, seq_length].
+        The position of each token, e.g. for several sequences packed into one.
 
     Returns:
       float tensor with same shape as `input_tensor`.
@@ -508,25 +519,29 @@ def embedding_postprocessor(input_tensor,
         # for position [0, 1, 2, ..., max_position_embeddings-1], and the current
         # sequence has positions [0, 1, 2, ... seq_length-1], so we can just
         # perform a slice.
-        position_embeddings = tf.slice(full_position_embeddings, [0, 0], [seq_length, -1])
-        # if seq_length < max_position_embeddings:
-        #     position_embeddings = tf.slice(full_position_embeddings, [0, 0],
-        #                                    [seq_length, -1])
-        # else:
-        #     position_embeddings = full_position_embeddings
-
-        num_dims = len(output.shape.as_list())
-
-        # Only the last two dimensions are relevant (`seq_length` and `width`), so
-        # we broadcast among the first dimensions, which is typically just
-        # the batch size.
-        position_broadcast_shape = []
-        for _ in range(num_dims - 2):
-            position_broadcast_shape.append(1)
-        position_broadcast_shape.extend([seq_length, width])
-        position_embeddings = tf.reshape(position_embeddings,
-                                         position_broadcast_shape)
-        output += position_embeddings
+        if position_ids is not None:
+            # the positions are given, e.g. each of the sequences packed into one starts from 0
+            output += tf.gather(full_position_embeddings, position_ids)
+        else:
+            position_embeddings = tf.slice(full_position_embeddings, [0, 0], [seq_length, -1])
+            # if seq_length < max_position_embeddings:
+            #     position_embeddings = tf.slice(full_position_embeddings, [0, 0],
+            #                                    [seq_length, -1])
+            # else:
+            #     position_embeddings = full_position_embeddings
+
+            num_dims = len(output.shape.as_list())
+
+            # Only the last two dimensions are relevant (`seq_length` and `width`), so
+            # we broadcast among the first dimensions, which is typically just
+            # the batch size.
+            position_broadcast_shape = []
+            for _ in range(num_dims - 2):
+                position_broadcast_shape.append(1)
+            position_broadcast_shape.extend([seq_length, width])
+            position_embeddings = tf.reshape(position_embeddings,
+                                             position_broadcast_shape)
+            output += position_embeddings
 
     output = layer_norm_and_dropout(output, dropout_prob)
     return output
@@ -566,6 +581,23 @@ def create_attention_mask_from_input_mask(from_tensor, to_mask):
     return mask
 
 
+def create_attention_mask_from_packed_mask(packed_mask):
+    """Create 3D block-diagonal attention mask for several sequences packed into one.
+
+    Args:
+      packed_mask: int32 Tensor of shape [batch_size, seq_length], where the tokens
+        of the k-th sequence in a row are marked by k (starting from 1) and the
+        padding by 0.
+
+    Returns:
+      float Tensor of shape [batch_size, seq_length, seq_length], each token only
+      attends to the tokens of its own sequence.
+    """
+    same_sequence = tf.equal(tf.expand_dims(packed_mask, 2), tf.expand_dims(packed_mask, 1))
+    not_padding = tf.expand_dims(tf.greater(packed_mask, 0), 1)
+    return tf.cast(tf.logical_and(same_sequence, not_padding), tf.float32)
+
+
 def attention_layer(from_tensor,
                     to_tensor,
                     attention_mask=None,
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import sys
+from collections import OrderedDict, defaultdict
+
+__all__ = ['EmbeddingCache']
+
+
+class EmbeddingCache:
+    """A memory-bounded cache of sentence embeddings, evicting by LRU or LFU.
+
+    Keys are the normalized text prefixed by a hash of the serving config, so that
+    embeddings computed under a different pooling/model setting never collide.
+    """
+
+    def __init__(self, max_bytes, policy, args):
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.do_lower_case = args.do_lower_case
+        config = {k: str(getattr(args, k)) for k in ('model_dir', 'tuned_model_dir', 'ckpt_name', 'max_seq_len',
+                                                      'pooling_strategy', 'pooling_layer', 'mask_cls_sep',
+                                                      'do_lower_case', 'fp16')}
+        self._prefix = hashlib.md5(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+        self._data = OrderedDict()  # key -> embedding, ordered by the last access
+        self._freq = {}  # key -> number of access, only for LFU
+        self._freq_keys = defaultdict(OrderedDict)  # number of access -> keys, only for LFU
+        self._min_freq = 0
+        self.num_bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def key(self, seq):
+        if isinstance(seq, list):
+            # already tokenized, tokens are joined by a separator that can not appear in the text
+            text = '\x1f'.join(seq)
+        else:
+            text = ' '.join(seq.split())
+            if self.do_lower_case:
+                text = text.lower()
+        return self._prefix + text
+
+    def get(self, key):
+        if key in self._data:
+            self._touch(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        """add an embedding to the cache and returns the number of evicted entries"""
+        if key in self._data:
+            return 0
+        size = value.nbytes + sys.getsizeof(key)
+        if size > self.max_bytes:
+            return 0
+        num_evicted = 0
+        while self.num_bytes + size > self.max_bytes:
+            self._evict()
+            num_evicted += 1
+        self._data[key] = value
+        self.num_bytes += size
+        if self.policy == 'LFU':
+            self._freq[key] = 1
+            self._freq_keys[1][key] = None
+            self._min_freq = 1
+        return num_evicted
+
+    def _touch(self, key):
+        if self.policy == 'LFU':
+            freq = self._freq[key]
+            del self._freq_keys[freq][key]
+            if not self._freq_keys[freq]:
+                del self._freq_keys[freq]
+                if self._min_freq == freq:
+                    self._min_freq = freq + 1
+            self._freq[key] = freq + 1
+            self._freq_keys[freq + 1][key] = None
+        else:
+            self._data.move_to_end(key)
+
+    def _evict(self):
+        if self.policy == 'LFU':
+            # the least frequently used, ties are broken by the least recently used
+            key, _ = self._freq_keys[self._min_freq].popitem(last=False)
+            if not self._freq_keys[self._min_freq]:
+                del self._freq_keys[self._min_freq]
+                self._min_freq = min(self._freq_keys) if self._freq_keys else 0
+            del self._freq[key]
+            value = self._data.pop(key)
+        else:
+            key, value = self._data.popitem(last=False)
+        self.num_bytes -= value.nbytes + sys.getsizeof(key)
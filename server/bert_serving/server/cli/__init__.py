@@ -12,6 +12,40 @@ def benchmark():
     run_benchmark(args)
 
 
+def benchmark_sink():
+    from bert_serving.server.benchmark import run_sink_benchmark
+    from bert_serving.server.helper import get_run_args, get_sink_benchmark_parser
+    args = get_run_args(get_sink_benchmark_parser)
+    run_sink_benchmark(args)
+
+
+def benchmark_features():
+    from bert_serving.server.benchmark import run_feature_benchmark
+    from bert_serving.server.helper import get_run_args, get_feature_benchmark_parser
+    args = get_run_args(get_feature_benchmark_parser)
+    run_feature_benchmark(args)
+
+
+def benchmark_packing():
+    from bert_serving.server.benchmark import run_packing_benchmark
+    from bert_serving.server.helper import get_run_args, get_packing_benchmark_parser
+    args = get_run_args(get_packing_benchmark_parser)
+    run_packing_benchmark(args)
+
+
+def export():
+    from termcolor import colored
+    from bert_serving.server.graph import optimize_graph
+    from bert_serving.server.helper import get_run_args, get_export_parser, normalize_args, set_logger
+    args = get_run_args(get_export_parser)
+    if not args.graph_cache_dir:
+        raise SystemExit('"graph_cache_dir" is required for exporting the graph')
+    # the same args as the server, otherwise the server does not find the exported graph
+    logger = set_logger(colored('GRAPHOPT', 'cyan'), args.verbose)
+    if not optimize_graph(normalize_args(args, logger), logger):
+        raise SystemExit('graph optimization fails')
+
+
 def terminate():
     from bert_serving.server import BertServer
     from bert_serving.server.helper import get_run_args, get_shutdown_parser
@@ -0,0 +1,57 @@
+import threading
+from queue import Queue
+
+import numpy as np
+
+__all__ = ['SessionEngine']
+
+_input_names = ['input_ids', 'input_mask', 'input_type_ids']
+
+
+class SessionEngine:
+    """Runs the optimized graph in one long-lived tf.Session fed with padded numpy arrays
+
+    Unlike Estimator.predict, the graph is imported only once and there is no tf.data pipeline in between.
+    The next batches are prepared by a background thread while the session runs the current one.
+    """
+
+    def __init__(self, tf, graph_path, config):
+        with tf.gfile.GFile(graph_path, 'rb') as f:
+            graph_def = tf.GraphDef()
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.inputs = [self.graph.get_tensor_by_name(k + ':0') for k in _input_names]
+        self.output = self.graph.get_tensor_by_name('final_encodes:0')
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+    def run(self, features):
+        return self.sess.run(self.output, feed_dict={t: features[k] for t, k in zip(self.inputs, _input_names)})
+
+    def predict(self, input_gen, prefetch_size=1):
+        """run the batches from input_gen, yield a dict of "client_id" and "encodes" like Estimator.predict"""
+        queue = Queue(maxsize=max(1, prefetch_size))
+
+        def prefetch():
+            # tokenization runs in this thread, while sess.run releases the GIL during inference
+            try:
+                for features in input_gen:
+                    queue.put({k: np.asarray(v, dtype=np.int32) if k in _input_names else v
+                               for k, v in features.items()})
+            except Exception as e:
+                queue.put(e)
+            else:
+                queue.put(None)
+
+        threading.Thread(target=prefetch, daemon=True).start()
+        while True:
+            features = queue.get()
+            if features is None:
+                break
+            if isinstance(features, Exception):
+                raise features
+            yield {'client_id': features['client_id'], 'encodes': self.run(features)}
+
+    def close(self):
+        self.sess.close()
@@ -1,4 +1,5 @@
 import contextlib
+import hashlib
 import json
 import os
 import tempfile
@@ -9,7 +10,7 @@ from termcolor import colored
 from .bert import modeling
 from .helper import import_tf, set_logger
 
-__all__ = ['PoolingStrategy', 'optimize_graph']
+__all__ = ['PoolingStrategy', 'optimize_graph', 'get_graph_key', 'build_encodes']
 
 
 class PoolingStrategy(Enum):
@@ -33,6 +34,95 @@ class PoolingStrategy(Enum):
             raise ValueError()
 
 
+def locate_packed_sequences(tf, packed_mask):
+    """find the sequences packed in the rows of "packed_mask", where the k-th sequence of a row is marked by k
+
+    returns the position of each token in its own sequence, the flat indices of the tokens of each sequence
+    padded to the longest one, and the mask of these indices
+    """
+    shape = tf.shape(packed_mask)
+    num_seq = tf.reduce_max(packed_mask, axis=1)
+    total_seq = tf.reduce_sum(num_seq)
+    # index of the sequence of each token among all sequences of the batch, the padding goes to an extra one
+    seq_index = tf.reshape(tf.where(packed_mask > 0,
+                                    packed_mask - 1 + tf.expand_dims(tf.cumsum(num_seq, exclusive=True), 1),
+                                    tf.fill(shape, total_seq)), [-1])
+    token_index = tf.range(shape[0] * shape[1])
+    seq_start = tf.unsorted_segment_min(token_index, seq_index, total_seq + 1)
+    seq_len = tf.unsorted_segment_sum(tf.ones_like(token_index), seq_index, total_seq + 1)[:-1]
+    position_ids = tf.where(packed_mask > 0, tf.reshape(token_index - tf.gather(seq_start, seq_index), shape),
+                            tf.zeros_like(packed_mask))
+    packed_index = tf.minimum(tf.expand_dims(seq_start[:-1], 1) + tf.expand_dims(tf.range(tf.reduce_max(seq_len)), 0),
+                              shape[0] * shape[1] - 1)
+    return position_ids, packed_index, tf.sequence_mask(seq_len, dtype=tf.int32)
+
+
+def build_encodes(tf, args, bert_config, input_ids, input_mask, input_type_ids):
+    """build the model on the input tensors, and pool its encoder layers into "final_encodes" by the graph args"""
+    packed_args = {}
+    if args.sequence_packing:
+        # several sequences are packed into a row, "input_mask" marks the tokens of the k-th one by k
+        position_ids, packed_index, packed_mask = locate_packed_sequences(tf, input_mask)
+        packed_args = {'attention_mask': modeling.create_attention_mask_from_packed_mask(input_mask),
+                       'position_ids': position_ids}
+
+    model = modeling.BertModel(
+        config=bert_config,
+        is_training=False,
+        input_ids=input_ids,
+        input_mask=input_mask,
+        token_type_ids=input_type_ids,
+        use_one_hot_embeddings=False,
+        **packed_args)
+
+    minus_mask = lambda x, m: x - tf.expand_dims(1.0 - m, axis=-1) * 1e30
+    mul_mask = lambda x, m: x * tf.expand_dims(m, axis=-1)
+    masked_reduce_max = lambda x, m: tf.reduce_max(minus_mask(x, m), axis=1)
+    masked_reduce_mean = lambda x, m: tf.reduce_sum(mul_mask(x, m), axis=1) / (
+            tf.reduce_sum(m, axis=1, keepdims=True) + 1e-10)
+
+    with tf.variable_scope("pooling"):
+        if len(args.pooling_layer) == 1:
+            encoder_layer = model.all_encoder_layers[args.pooling_layer[0]]
+        else:
+            all_layers = [model.all_encoder_layers[l] for l in args.pooling_layer]
+            encoder_layer = tf.concat(all_layers, -1)
+
+        if args.sequence_packing:
+            # move the tokens of each packed sequence into a row of its own, so that they are pooled
+            # like an unpacked batch, giving one row per sequence in their packing order
+            encoder_layer = tf.gather(
+                tf.reshape(encoder_layer, [-1, modeling.get_shape_list(encoder_layer)[-1]]), packed_index)
+            input_mask = packed_mask
+
+        input_mask = tf.cast(input_mask, tf.float32)
+        if args.pooling_strategy == PoolingStrategy.REDUCE_MEAN:
+            pooled = masked_reduce_mean(encoder_layer, input_mask)
+        elif args.pooling_strategy == PoolingStrategy.REDUCE_MAX:
+            pooled = masked_reduce_max(encoder_layer, input_mask)
+        elif args.pooling_strategy == PoolingStrategy.REDUCE_MEAN_MAX:
+            pooled = tf.concat([masked_reduce_mean(encoder_layer, input_mask),
+                                masked_reduce_max(encoder_layer, input_mask)], axis=1)
+        elif args.pooling_strategy == PoolingStrategy.FIRST_TOKEN or \
+                args.pooling_strategy == PoolingStrategy.CLS_TOKEN:
+            pooled = tf.squeeze(encoder_layer[:, 0:1, :], axis=1)
+        elif args.pooling_strategy == PoolingStrategy.LAST_TOKEN or \
+                args.pooling_strategy == PoolingStrategy.SEP_TOKEN:
+            seq_len = tf.cast(tf.reduce_sum(input_mask, axis=1), tf.int32)
+            rng = tf.range(0, tf.shape(seq_len)[0])
+            indexes = tf.stack([rng, seq_len - 1], 1)
+            pooled = tf.gather_nd(encoder_layer, indexes)
+        elif args.pooling_strategy == PoolingStrategy.NONE:
+            pooled = mul_mask(encoder_layer, input_mask)
+        else:
+            raise NotImplementedError()
+
+    if args.fp16:
+        pooled = tf.cast(pooled, tf.float16)
+
+    return tf.identity(pooled, 'final_encodes')
+
+
 def optimize_graph(args, logger=None):
     if not logger:
         logger = set_logger(colored('GRAPHOPT', 'cyan'), args.verbose)
@@ -56,6 +146,14 @@ def optimize_graph(args, logger=None):
         with tf.gfile.GFile(config_fp, 'r') as f:
             bert_config = modeling.BertConfig.from_dict(json.load(f))
 
+        graph_file = None
+        if args.graph_cache_dir:
+            graph_file = os.path.join(args.graph_cache_dir,
+                                      'graph-%s.pb' % get_graph_key(args, tf, config_fp, init_checkpoint))
+            if tf.gfile.Exists(graph_file):
+                logger.info('reuse the cached graph: %s' % graph_file)
+                return graph_file, bert_config
+
         logger.info('build graph...')
         # input placeholders, not sure if they are friendly to XLA
         input_ids = tf.placeholder(tf.int32, (None, None), 'input_ids')
@@ -66,14 +164,7 @@ def optimize_graph(args, logger=None):
 
         with jit_scope():
             input_tensors = [input_ids, input_mask, input_type_ids]
-
-            model = modeling.BertModel(
-                config=bert_config,
-                is_training=False,
-                input_ids=input_ids,
-                input_mask=input_mask,
-                token_type_ids=input_type_ids,
-                use_one_hot_embeddings=False)
+            output_tensors = [build_encodes(tf, args, bert_config, input_ids, input_mask, input_type_ids)]
 
             tvars = tf.trainable_variables()
 
@@ -82,46 +173,6 @@ def optimize_graph(args, logger=None):
 
             tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
 
-            minus_mask = lambda x, m: x - tf.expand_dims(1.0 - m, axis=-1) * 1e30
-            mul_mask = lambda x, m: x * tf.expand_dims(m, axis=-1)
-            masked_reduce_max = lambda x, m: tf.reduce_max(minus_mask(x, m), axis=1)
-            masked_reduce_mean = lambda x, m: tf.reduce_sum(mul_mask(x, m), axis=1) / (
-                    tf.reduce_sum(m, axis=1, keepdims=True) + 1e-10)
-
-            with tf.variable_scope("pooling"):
-                if len(args.pooling_layer) == 1:
-                    encoder_layer = model.all_encoder_layers[args.pooling_layer[0]]
-                else:
-                    all_layers = [model.all_encoder_layers[l] for l in args.pooling_layer]
-                    encoder_layer = tf.concat(all_layers, -1)
-
-                input_mask = tf.cast(input_mask, tf.float32)
-                if args.pooling_strategy == PoolingStrategy.REDUCE_MEAN:
-                    pooled = masked_reduce_mean(encoder_layer, input_mask)
-                elif args.pooling_strategy == PoolingStrategy.REDUCE_MAX:
-                    pooled = masked_reduce_max(encoder_layer, input_mask)
-                elif args.pooling_strategy == PoolingStrategy.REDUCE_MEAN_MAX:
-                    pooled = tf.concat([masked_reduce_mean(encoder_layer, input_mask),
-                                        masked_reduce_max(encoder_layer, input_mask)], axis=1)
-                elif args.pooling_strategy == PoolingStrategy.FIRST_TOKEN or \
-                        args.pooling_strategy == PoolingStrategy.CLS_TOKEN:
-                    pooled = tf.squeeze(encoder_layer[:, 0:1, :], axis=1)
-                elif args.pooling_strategy == PoolingStrategy.LAST_TOKEN or \
-                        args.pooling_strategy == PoolingStrategy.SEP_TOKEN:
-                    seq_len = tf.cast(tf.reduce_sum(input_mask, axis=1), tf.int32)
-                    rng = tf.range(0, tf.shape(seq_len)[0])
-                    indexes = tf.stack([rng, seq_len - 1], 1)
-                    pooled = tf.gather_nd(encoder_layer, indexes)
-                elif args.pooling_strategy == PoolingStrategy.NONE:
-                    pooled = mul_mask(encoder_layer, input_mask)
-                else:
-                    raise NotImplementedError()
-
-            if args.fp16:
-                pooled = tf.cast(pooled, tf.float16)
-
-            pooled = tf.identity(pooled, 'final_encodes')
-            output_tensors = [pooled]
             tmp_g = tf.get_default_graph().as_graph_def()
 
         with tf.Session(config=config) as sess:
@@ -141,15 +192,50 @@ def optimize_graph(args, logger=None):
             tmp_g = convert_variables_to_constants(sess, tmp_g, [n.name[:-2] for n in output_tensors],
                                                    use_fp16=args.fp16)
 
-        tmp_file = tempfile.NamedTemporaryFile('w', delete=False, dir=args.graph_tmp_dir).name
+        if graph_file:
+            tf.gfile.MakeDirs(args.graph_cache_dir)
+            tmp_file = '%s.%d.tmp' % (graph_file, os.getpid())
+        else:
+            tmp_file = tempfile.NamedTemporaryFile('w', delete=False, dir=args.graph_tmp_dir).name
         logger.info('write graph to a tmp file: %s' % tmp_file)
-        with tf.gfile.GFile(tmp_file, 'wb') as f:
-            f.write(tmp_g.SerializeToString())
+        try:
+            with tf.gfile.GFile(tmp_file, 'wb') as f:
+                f.write(tmp_g.SerializeToString())
+            if graph_file:
+                # renamed only when complete, so that a server starting meanwhile never reads a partial graph
+                tf.gfile.Rename(tmp_file, graph_file, overwrite=True)
+        except Exception:
+            # do not leave a partial graph behind, e.g. when the disk is full
+            if tf.gfile.Exists(tmp_file):
+                tf.gfile.Remove(tmp_file)
+            raise
+        if graph_file:
+            logger.info('cache graph at: %s' % graph_file)
+            return graph_file, bert_config
         return tmp_file, bert_config
     except Exception:
         logger.error('fail to optimize the graph!', exc_info=True)
 
 
+def get_graph_key(args, tf, config_fp, init_checkpoint):
+    """a hash of everything the optimized graph depends on: the config, the checkpoint and the graph arguments"""
+    from . import __version__
+    h = hashlib.sha1()
+    for v in [__version__, tf.__version__, args.fp16, args.xla, args.sequence_packing,
+              args.pooling_layer, args.pooling_strategy]:
+        h.update(str(v).encode('utf-8'))
+    for fp in [config_fp] + sorted(tf.gfile.Glob(init_checkpoint + '.*')):
+        h.update(os.path.basename(fp).encode('utf-8'))
+        if fp == config_fp or fp.endswith('.index'):
+            # the index of a checkpoint keeps the checksum of every tensor, so the large data files
+            # are identified by their size only
+            with tf.gfile.GFile(fp, 'rb') as f:
+                h.update(f.read())
+        else:
+            h.update(str(tf.gfile.Stat(fp).length).encode('utf-8'))
+    return h.hexdigest()
+
+
 def convert_variables_to_constants(sess,
                                    input_graph_def,
                                    output_node_names,
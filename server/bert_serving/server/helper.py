@@ -11,7 +11,8 @@ from termcolor import colored
 from zmq.utils import jsonapi
 
 __all__ = ['set_logger', 'send_ndarray', 'get_args_parser',
-           'check_tf_version', 'auto_bind', 'import_tf', 'TimeContext']
+           'check_tf_version', 'auto_bind', 'import_tf', 'TimeContext',
+           'estimate_num_tokens', 'get_padding_buckets', 'normalize_args']
 
 
 def set_logger(context, verbose=False):
@@ -56,6 +57,59 @@ def send_ndarray(src, dest, X, req_id=b'', flags=0, copy=True, track=False):
     return src.send_multipart([dest, jsonapi.dumps(md), X, req_id], flags, copy=copy, track=track)
 
 
+def estimate_num_tokens(seq):
+    """a cheap estimation of the number of tokens in a sequence without running the tokenizer"""
+    if isinstance(seq, list):
+        # already tokenized, plus [CLS] and [SEP]
+        return len(seq) + 2
+    # count words separated by whitespace, CJK characters (3 bytes in utf-8) are counted one by one
+    return len(seq.split()) + (len(seq.encode('utf-8')) - len(seq)) // 2 + 2
+
+
+def get_padding_buckets(args, bert_config):
+    """the padding lengths in ascending order, those over "max_position_embeddings" can not be used"""
+    return sorted(b for b in args.padding_buckets if b <= bert_config.max_position_embeddings)
+
+
+def normalize_args(args, logger):
+    """turn off the options that do not work together, in place.
+
+    The server and "bert-serving-export" must both call it, the optimized graph is cached by the normalized args
+    """
+    from .graph import PoolingStrategy
+    from .shm import SHM_DIR
+    if args.least_loaded_dispatch and args.num_tokenizer:
+        logger.warning('"least_loaded_dispatch" does not work with "num_tokenizer", it is disabled')
+        args.least_loaded_dispatch = False
+    if args.padding_buckets and args.max_seq_len is not None:
+        logger.warning('"padding_buckets" only works with "max_seq_len=NONE", it is ignored')
+        args.padding_buckets = []
+    if args.sequence_packing:
+        if args.pooling_strategy == PoolingStrategy.NONE:
+            logger.warning('"sequence_packing" does not work with "pooling_strategy=NONE", it is disabled')
+            args.sequence_packing = False
+        elif args.mask_cls_sep:
+            logger.warning('"sequence_packing" does not work with "mask_cls_sep", it is disabled')
+            args.sequence_packing = False
+    if args.sliding_window and args.pooling_strategy == PoolingStrategy.NONE:
+        logger.warning('"sliding_window" does not work with "pooling_strategy=NONE", it is disabled')
+        args.sliding_window = False
+    if args.compact_tokens and not args.show_tokens_to_client:
+        logger.warning('"compact_tokens" only works with "show_tokens_to_client", it is ignored')
+        args.compact_tokens = False
+    if args.shared_memory and not os.path.isdir(SHM_DIR):
+        logger.warning('"shared_memory" requires %s, it is disabled' % SHM_DIR)
+        args.shared_memory = False
+    if args.ragged_output:
+        if args.pooling_strategy != PoolingStrategy.NONE:
+            logger.warning('"ragged_output" only works with "pooling_strategy=NONE", it is ignored')
+            args.ragged_output = False
+        elif args.shared_memory:
+            logger.warning('"shared_memory" does not work with "ragged_output", it is disabled')
+            args.shared_memory = False
+    return args
+
+
 def check_max_seq_len(value):
     if value is None or value.lower() == 'none':
         return None
@@ -88,12 +142,37 @@ def get_args_parser():
                         help='filename of the JSON config file for BERT model.')
     group1.add_argument('-graph_tmp_dir', type=str, default=None,
                         help='path to graph temp file')
+    group1.add_argument('-graph_cache_dir', type=str, default=None,
+                        help='directory of the cached optimized graphs. A graph is reused by the next start '
+                             'with the same model and graph parameters, instead of optimizing it again')
 
     group2 = parser.add_argument_group('BERT Parameters',
                                        'config how BERT model and pooling works')
     group2.add_argument('-max_seq_len', type=check_max_seq_len, default=25,
                         help='maximum length of a sequence, longer sequence will be trimmed on the right side. '
                              'set it to NONE for dynamically using the longest sequence in a (mini)batch.')
+    group2.add_argument('-length_bucketing', action='store_true', default=False,
+                        help='sort the sequences of a large request by their estimated length before splitting it '
+                             'into batches, so that each batch is padded less. Only works with "max_seq_len=NONE"')
+    group2.add_argument('-padding_buckets', type=int, nargs='*', default=[],
+                        help='pad each batch to the smallest of these lengths that fits it, e.g. 16 32 64 128 256, '
+                             'so that the model only sees a few shapes. The number of rows is padded to a power of '
+                             'two as well, and each worker runs a batch of every shape at startup to compile them '
+                             'before it reports ready. Only works with "max_seq_len=NONE"')
+    group2.add_argument('-sequence_packing', action='store_true', default=False,
+                        help='pack several short sequences into one row of a batch, each of them only attends to '
+                             'itself and is pooled on its own. Does not work with "pooling_strategy=NONE" '
+                             'and "mask_cls_sep"')
+    group2.add_argument('-sliding_window', action='store_true', default=False,
+                        help='split a single sequence longer than "max_seq_len" into overlapping windows instead of '
+                             'trimming it, the vectors of its windows are pooled into one on the server. '
+                             'Does not work with "pooling_strategy=NONE"')
+    group2.add_argument('-window_stride', type=int, default=0,
+                        help='number of tokens between the starts of two windows in "sliding_window", '
+                             'set to 0 for half a window')
+    group2.add_argument('-window_pooling', type=str, default='MEAN', choices=['MEAN', 'MAX', 'LENGTH_WEIGHTED'],
+                        help='how the vectors of the windows of a sequence are pooled in "sliding_window", '
+                             '"LENGTH_WEIGHTED" is the mean weighted by the number of tokens of each window')
     group2.add_argument('-cased_tokenization', dest='do_lower_case', action='store_false', default=True,
                         help='Whether tokenizer should skip the default lowercasing and accent removal.'
                              'Should be used for e.g. the multilingual cased pretrained BERT model.')
@@ -109,6 +188,10 @@ def get_args_parser():
                         then the embedding is preserved, otherwise the embedding is masked to zero before pooling')
     group2.add_argument('-show_tokens_to_client', action='store_true', default=False,
                         help='sending tokenization results to client')
+    group2.add_argument('-compact_tokens', action='store_true', default=False,
+                        help='send tokenization results as int32 token ids instead of strings, the client maps '
+                             'them to strings by the vocabulary it fetches once from the server. '
+                             'Only works with "show_tokens_to_client"')
 
     group3 = parser.add_argument_group('Serving Configs',
                                        'config how server utilizes GPU/CPU resources')
@@ -116,6 +199,9 @@ def get_args_parser():
                         help='server port for receiving data from client')
     group3.add_argument('-port_out', '-port_result', type=int, default=5556,
                         help='server port for sending result to client')
+    group3.add_argument('-router_result', action='store_true', default=False,
+                        help='deliver results to each client through a ROUTER socket instead of broadcasting them '
+                             'through PUB, no result is dropped under load. Clients must use "router_result=True"')
     group3.add_argument('-http_port', type=int, default=None,
                         help='server port for receiving HTTP requests')
     group3.add_argument('-http_max_connect', type=int, default=10,
@@ -124,11 +210,63 @@ def get_args_parser():
                         help='setting "Access-Control-Allow-Origin" for HTTP requests')
     group3.add_argument('-num_worker', type=int, default=1,
                         help='number of server instances')
+    group3.add_argument('-num_tokenizer', type=int, default=0,
+                        help='number of tokenizer processes between the ventilator and the workers, they turn raw text '
+                             'into padded id arrays so that workers only run the model. Set to 0 to tokenize in workers')
+    group3.add_argument('-num_sink', type=int, default=1,
+                        help='number of sink processes that assemble results, jobs are partitioned among them by '
+                             'the hash of the client and request id. Use more than one with many CPU workers')
     group3.add_argument('-max_batch_size', type=int, default=256,
                         help='maximum number of sequences handled by each worker')
+    group3.add_argument('-max_tokens_per_batch', type=int, default=0,
+                        help='maximum number of tokens run by the model at once, including the padding. Jobs are '
+                             'split by the estimated tokens of their sequences, and a worker runs a batch still over '
+                             'it after tokenization in slices of rows. 0 means no limit')
     group3.add_argument('-priority_batch_size', type=int, default=16,
                         help='batch smaller than this size will be labeled as high priority,'
                              'and jumps forward in the job queue')
+    group3.add_argument('-least_loaded_dispatch', action='store_true', default=False,
+                        help='dispatch each job to the worker with the fewest pending sequences, instead of '
+                             'a randomly chosen socket. "priority_batch_size" is ignored in this mode')
+    group3.add_argument('-micro_batch', action='store_true', default=False,
+                        help='merge small requests from different clients into one worker batch, which is flushed '
+                             'once it reaches "max_batch_size" or waits longer than "micro_batch_timeout"')
+    group3.add_argument('-micro_batch_timeout', type=int, default=10,
+                        help='maximum time (ms) a request waits in the micro-batch before it is sent to workers')
+    group3.add_argument('-max_inflight_seq', type=int, default=0,
+                        help='maximum number of sequences being processed by the server, new requests over the cap '
+                             'are rejected with a "server busy" reply. Set to 0 for no limit')
+    group3.add_argument('-max_inflight_size', type=float, default=0,
+                        help='maximum total size (MB) of the requests being processed by the server, new requests '
+                             'over the cap are rejected with a "server busy" reply. Set to 0 for no limit')
+    group3.add_argument('-fair_queuing', action='store_true', default=False,
+                        help='queue jobs per client identity and share the workers fairly among clients, '
+                             'so that a client with a huge request does not starve the others. '
+                             'A merged "micro_batch" is charged to each of its clients by its number of sequences')
+    group3.add_argument('-client_weight', type=str, nargs='*', default=[],
+                        help='weights of clients in fair queuing, given as "identity=weight". '
+                             'A client with weight 2 gets twice the share of a client with the default weight 1')
+    group3.add_argument('-client_rate_limit', type=str, nargs='*', default=[],
+                        help='maximum number of sequences per second of clients in fair queuing, given as '
+                             '"identity=rate", or a single "rate" that applies to all other clients')
+    group3.add_argument('-cache_size', type=float, default=0,
+                        help='memory (MB) of the embedding cache, repeated sequences are answered from the cache '
+                             'without running the model. Set to 0 to disable the cache')
+    group3.add_argument('-cache_policy', type=str, default='LRU', choices=['LRU', 'LFU'],
+                        help='the eviction policy of the embedding cache')
+    group3.add_argument('-ragged_output', action='store_true', default=False,
+                        help='send token-level embeddings ("pooling_strategy=NONE") as all valid tokens of all '
+                             'sentences without padding, plus the number of tokens of each sentence')
+    group3.add_argument('-shared_memory', action='store_true', default=False,
+                        help='assemble the results in shared memory (/dev/shm), where workers write their rows '
+                             'directly, instead of sending them to the sink')
+    group3.add_argument('-sink_memory', type=float, default=0,
+                        help='memory budget (MB) of the results being assembled in each sink, the server rejects new '
+                             'requests as busy while a sink is over it. Set to 0 for no limit')
+    group3.add_argument('-sink_job_ttl', type=int, default=0,
+                        help='seconds that a sink keeps a pending job that receives no result after its dispatch to '
+                             'workers, e.g. because its worker died, the job is dropped afterwards. '
+                             'Set to 0 to keep pending jobs forever')
     group3.add_argument('-cpu', action='store_true', default=False,
                         help='running on CPU (default on GPU)')
     group3.add_argument('-xla', action='store_true', default=False,
@@ -146,6 +284,10 @@ def get_args_parser():
     group3.add_argument('-prefetch_size', type=int, default=10,
                         help='the number of batches to prefetch on each worker. When running on a CPU-only machine, \
                         this is set to 0 for comparability')
+    group3.add_argument('-session_engine', action='store_true', default=False,
+                        help='run the graph in a long-lived session fed with numpy arrays instead of the estimator, '
+                             'the next batch is tokenized while the current one is running. Reduces the latency '
+                             'of small batches')
     group3.add_argument('-fixed_embed_length', action='store_true', default=False,
                         help='when "max_seq_len" is set to None, the server determines the "max_seq_len" according to '
                              'the actual sequence lengths within each batch. When "pooling_strategy=NONE", '
@@ -228,6 +370,88 @@ def get_benchmark_parser():
     return parser
 
 
+def get_export_parser():
+    parser = get_args_parser()
+    parser.description = 'Optimize the graph of a BertServer ahead of time and store it in "graph_cache_dir"'
+    return parser
+
+
+def get_sink_benchmark_parser():
+    parser = argparse.ArgumentParser()
+    parser.description = 'Benchmark BertSink locally with many concurrent pending jobs, no model is required'
+
+    parser.add_argument('-num_pending_job', type=int, nargs='*', default=[100, 1000, 10000],
+                        help='number of concurrent pending jobs in each experiment')
+    parser.add_argument('-num_sink', type=int, nargs='*', default=[1, 2, 4],
+                        help='number of sink processes in each experiment')
+    parser.add_argument('-num_partial', type=int, default=4,
+                        help='number of partial results of each job')
+    parser.add_argument('-partial_size', type=int, default=8,
+                        help='number of sequences in each partial result')
+    parser.add_argument('-embed_dim', type=int, default=768,
+                        help='dimension of the embeddings')
+    parser.add_argument('-port_out', '-port_result', type=int, default=5556,
+                        help='port for the sink to publish results')
+    return parser
+
+
+def get_feature_benchmark_parser():
+    parser = argparse.ArgumentParser()
+    parser.description = 'Benchmark the conversion of sentences into features, no model is required'
+
+    parser.add_argument('-model_dir', type=str, required=True,
+                        help='directory of a pretrained BERT model, only its vocab.txt is used')
+    parser.add_argument('-batch_size', type=int, nargs='*', default=[16, 64, 256],
+                        help='number of sentences in each batch')
+    parser.add_argument('-max_seq_len', type=int, nargs='*', default=[25, 128],
+                        help='maximum length of the sentences')
+    parser.add_argument('-mask_cls_sep', action='store_true', default=False,
+                        help='masking the embedding on [CLS] and [SEP] with zero')
+    parser.add_argument('-client_vocab_file', type=str, default='README.md',
+                        help='file path for building the words of the sentences')
+    parser.add_argument('-num_repeat', type=int, default=10,
+                        help='number of repeats per experiment (must >2), '
+                             'as the first two results are omitted for warm-up effect')
+    return parser
+
+
+def get_packing_benchmark_parser():
+    from .graph import PoolingStrategy
+
+    parser = argparse.ArgumentParser()
+    parser.description = 'Check that packed batches give the same encodes as unpacked ones on a small random model, ' \
+                         'and compare their speed, no pretrained model is required'
+
+    parser.add_argument('-pooling_strategy', type=PoolingStrategy.from_string, nargs='*',
+                        default=[v for v in PoolingStrategy if v != PoolingStrategy.NONE],
+                        choices=[v for v in PoolingStrategy if v != PoolingStrategy.NONE],
+                        help='the pooling strategies to check, "NONE" does not work with sequence packing')
+    parser.add_argument('-pooling_layer', type=int, nargs='+', default=[-2],
+                        help='the encoder layer(s) that receives pooling')
+    parser.add_argument('-batch_size', type=int, nargs='*', default=[16, 64],
+                        help='number of sentences in each batch')
+    parser.add_argument('-max_seq_len', type=int, nargs='*', default=[32, 128],
+                        help='maximum length of the sentences, also the length of the packed rows')
+    parser.add_argument('-vocab_size', type=int, default=1000,
+                        help='vocabulary size of the random model')
+    parser.add_argument('-hidden_size', type=int, default=64,
+                        help='hidden size of the random model')
+    parser.add_argument('-num_hidden_layers', type=int, default=2,
+                        help='number of layers of the random model')
+    parser.add_argument('-num_attention_heads', type=int, default=4,
+                        help='number of attention heads of the random model')
+    parser.add_argument('-tolerance', type=float, default=1e-5,
+                        help='maximum absolute difference allowed between packed and unpacked encodes')
+    parser.add_argument('-seed', type=int, default=0,
+                        help='random seed of the model weights and the sentences')
+    parser.add_argument('-num_repeat', type=int, default=10,
+                        help='number of repeats per experiment (must >2), '
+                             'as the first two results are omitted for warm-up effect')
+    parser.add_argument('-verbose', action='store_true', default=False,
+                        help='turn on tensorflow logging for debug')
+    return parser
+
+
 def get_shutdown_parser():
     parser = argparse.ArgumentParser()
     parser.description = 'Shutting down a BertServer instance running on a specific port'
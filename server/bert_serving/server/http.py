@@ -17,7 +17,7 @@ class BertHTTPProxy(Process):
             from flask_compress import Compress
             from flask_cors import CORS
             from flask_json import FlaskJSON, as_json, JsonError
-            from bert_serving.client import ConcurrentBertClient
+            from bert_serving.client import ConcurrentBertClient, ServerBusyError
         except ImportError:
             raise ImportError('BertClient or Flask or its dependencies are not fully installed, '
                               'they are required for serving HTTP requests.'
@@ -26,6 +26,7 @@ class BertHTTPProxy(Process):
         # support up to 10 concurrent HTTP requests
         bc = ConcurrentBertClient(max_concurrency=self.args.http_max_connect,
                                   port=self.args.port, port_out=self.args.port_out,
+                                  router_result=self.args.router_result,
                                   output_fmt='list', ignore_all_checks=True)
         app = Flask(__name__)
         logger = set_logger(colored('PROXY', 'red'))
@@ -50,6 +51,9 @@ class BertHTTPProxy(Process):
                         'result': bc.encode(data['texts'], is_tokenized=bool(
                             data['is_tokenized']) if 'is_tokenized' in data else False)}
 
+            except ServerBusyError as e:
+                logger.warning('server busy, reject HTTP request from %s' % request.remote_addr)
+                raise JsonError(status_=503, description=str(e), type=str(type(e).__name__))
             except Exception as e:
                 logger.error('error when handling HTTP request', exc_info=True)
                 raise JsonError(description=str(e), type=str(type(e).__name__))
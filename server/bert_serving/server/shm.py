@@ -0,0 +1,40 @@
+import glob
+import hashlib
+import os
+
+import numpy as np
+
+__all__ = ['SHM_DIR', 'get_shm_path', 'open_shm_array', 'remove_shm_array', 'clear_shm_arrays']
+
+SHM_DIR = '/dev/shm'
+
+
+def get_shm_path(port, job_id):
+    """the shared memory file of a job, workers and the sink derive the same name from the job id"""
+    return os.path.join(SHM_DIR, 'bert-serving-%d-%s' % (port, hashlib.md5(job_id).hexdigest()))
+
+
+def open_shm_array(path, dtype, shape):
+    """map a shared memory file to an ndarray, the file is created (zero-filled) if it does not exist"""
+    num_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    # several workers may open the same file at the same time, so never truncate it
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if os.fstat(fd).st_size < num_bytes:
+            os.ftruncate(fd, num_bytes)
+    finally:
+        os.close(fd)
+    return np.memmap(path, dtype=dtype, mode='r+', shape=tuple(shape))
+
+
+def remove_shm_array(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def clear_shm_arrays(port):
+    """remove the files of all unfinished jobs, e.g. when the server shuts down"""
+    for path in glob.glob(os.path.join(SHM_DIR, 'bert-serving-%d-*' % port)):
+        remove_shm_array(path)
@@ -41,6 +41,10 @@ setup(
     entry_points={
         'console_scripts': ['bert-serving-start=bert_serving.server.cli:main',
                             'bert-serving-benchmark=bert_serving.server.cli:benchmark',
+                            'bert-serving-benchmark-sink=bert_serving.server.cli:benchmark_sink',
+                            'bert-serving-benchmark-features=bert_serving.server.cli:benchmark_features',
+                            'bert-serving-benchmark-packing=bert_serving.server.cli:benchmark_packing',
+                            'bert-serving-export=bert_serving.server.cli:export',
                             'bert-serving-terminate=bert_serving.server.cli:terminate'],
     },
     keywords='bert nlp tensorflow machine learning sentence encoding embedding serving',